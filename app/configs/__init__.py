@@ -5,14 +5,76 @@ import torch
 from pydantic import BaseModel
 
 
+def _parse_mapping(value: str) -> dict:
+    """Parses "detect=0,segment=1" style env values."""
+    mapping = {}
+    for entry in value.split(","):
+        if entry.strip():
+            key, _, number = entry.partition("=")
+            mapping[key.strip()] = float(number)
+    return mapping
+
+
+def _parse_list(value: str) -> list:
+    """Parses "cuda:0,cuda:1" style env values."""
+    return [entry.strip() for entry in value.split(",") if entry.strip()]
+
+
+_default_device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+
+
 class Config(BaseModel):
-    device: str = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+    device: str = _default_device
+    # One replica of the model per entry; a device listed twice runs two replicas on it side by side
+    sam2_devices: list = _parse_list(os.getenv("SAM2_DEVICES", _default_device))
+    gdino_devices: list = _parse_list(os.getenv("GDINO_DEVICES", _default_device))
+    diffusion_devices: list = _parse_list(os.getenv("DIFFUSION_DEVICES", _default_device))
     hf_home: Path = Path(os.getenv("PERSISTENT_VOLUME_DIR")) / "models"
+    jobs_dir: Path = Path(os.getenv("PERSISTENT_VOLUME_DIR")) / "jobs"
+    result_cache_dir: Path = Path(os.getenv("PERSISTENT_VOLUME_DIR")) / "result_cache"
+    converted_models_dir: Path = Path(os.getenv("PERSISTENT_VOLUME_DIR")) / "converted_models"
     sam2_model_id: str = os.getenv("SAM2_MODEL_ID")
     gdino_model_id: str = os.getenv("GDINO_MODEL_ID")
     diffusion_model_id: str = os.getenv("DIFFUSION_MODEL_ID")
     diffusion_controlnet_model_id: str = os.getenv("DIFFUSION_CONTROLNET_MODEL_ID")
     diffusion_orig_model_id: str = os.getenv("DIFFUSION_ORIG_MODEL_ID")
     cuda_frequent_empty_cache: bool = os.getenv("CUDA_FREQUENT_EMPTY_CACHE") == "1"
+    gpu_memory_high_water_mark: float = float(os.getenv("GPU_MEMORY_HIGH_WATER_MARK", "0.9"))
+    decoded_image_cache_size: int = int(os.getenv("DECODED_IMAGE_CACHE_SIZE", "32"))
+    decoded_image_cache_mb: int = int(os.getenv("DECODED_IMAGE_CACHE_MB", "512"))
+    sam2_max_batch_size: int = int(os.getenv("SAM2_MAX_BATCH_SIZE", "8"))
+    sam2_max_batch_wait_ms: float = float(os.getenv("SAM2_MAX_BATCH_WAIT_MS", "5"))
+    sam2_embedding_cache_size: int = int(os.getenv("SAM2_EMBEDDING_CACHE_SIZE", "32"))
+    sam2_embedding_cache_mb: int = int(os.getenv("SAM2_EMBEDDING_CACHE_MB", "1024"))
+    sam2_preprocess_workers: int = int(os.getenv("SAM2_PREPROCESS_WORKERS", "2"))
+    sam2_postprocess_workers: int = int(os.getenv("SAM2_POSTPROCESS_WORKERS", "2"))
+    gdino_text_cache_size: int = int(os.getenv("GDINO_TEXT_CACHE_SIZE", "64"))
+    gdino_text_cache_mb: int = int(os.getenv("GDINO_TEXT_CACHE_MB", "64"))
+    gdino_batch_chunk_size: int = int(os.getenv("GDINO_BATCH_CHUNK_SIZE", "8"))
+    gdino_preprocess_workers: int = int(os.getenv("GDINO_PREPROCESS_WORKERS", "2"))
+    gdino_postprocess_workers: int = int(os.getenv("GDINO_POSTPROCESS_WORKERS", "2"))
+    diffusion_max_batch_size: int = int(os.getenv("DIFFUSION_MAX_BATCH_SIZE", "4"))
+    diffusion_max_batch_wait_ms: float = float(os.getenv("DIFFUSION_MAX_BATCH_WAIT_MS", "0"))
+    diffusion_prompt_cache_size: int = int(os.getenv("DIFFUSION_PROMPT_CACHE_SIZE", "128"))
+    diffusion_prompt_cache_mb: int = int(os.getenv("DIFFUSION_PROMPT_CACHE_MB", "512"))
+    diffusion_prompt_cache_on_device: bool = os.getenv("DIFFUSION_PROMPT_CACHE_ON_DEVICE", "1") == "1"
+    diffusion_encode_workers: int = int(os.getenv("DIFFUSION_ENCODE_WORKERS", "2"))
+    diffusion_result_cache_mb: int = int(os.getenv("DIFFUSION_RESULT_CACHE_MB", "2048"))
+    sam2_max_queue_size: int = int(os.getenv("SAM2_MAX_QUEUE_SIZE", "256"))
+    sam2_max_queue_wait_s: float = float(os.getenv("SAM2_MAX_QUEUE_WAIT_S", "30"))
+    gdino_max_queue_size: int = int(os.getenv("GDINO_MAX_QUEUE_SIZE", "256"))
+    gdino_max_queue_wait_s: float = float(os.getenv("GDINO_MAX_QUEUE_WAIT_S", "30"))
+    diffusion_max_queue_size: int = int(os.getenv("DIFFUSION_MAX_QUEUE_SIZE", "16"))
+    diffusion_max_queue_wait_s: float = float(os.getenv("DIFFUSION_MAX_QUEUE_WAIT_S", "600"))
+    job_ttl_s: float = float(os.getenv("JOB_TTL_S", "86400"))
+    job_cleanup_interval_s: float = float(os.getenv("JOB_CLEANUP_INTERVAL_S", "600"))
+    gpu_task_priorities: dict = _parse_mapping(os.getenv("GPU_TASK_PRIORITIES", "detect=0,segment=0,generate=1,inpaint=1"))
+    gpu_task_weights: dict = _parse_mapping(os.getenv("GPU_TASK_WEIGHTS", "detect=1,segment=1,generate=1,inpaint=1"))
+    gpu_preempt_budget_ms: float = float(os.getenv("GPU_PREEMPT_BUDGET_MS", "500"))
+    lazy_model_loading: bool = os.getenv("LAZY_MODEL_LOADING") == "1"
+    model_idle_offload_s: float = float(os.getenv("MODEL_IDLE_OFFLOAD_S", "0"))
+    model_device_budget_mb: int = int(os.getenv("MODEL_DEVICE_BUDGET_MB", "0"))
+    model_load_concurrency: int = int(os.getenv("MODEL_LOAD_CONCURRENCY", "3"))
+    diffusion_safetensors_conversion: bool = os.getenv("DIFFUSION_SAFETENSORS_CONVERSION", "1") == "1"
 
 config = Config()
@@ -1,8 +1,20 @@
-import gc
-import queue
+import asyncio
+import json
+import shutil
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from importlib.metadata import PackageNotFoundError, version
+from typing import AsyncIterator, Callable, List, Optional, Union
 
+import diffusers
 import torch
+import torch.nn.functional as F
+from packaging.version import Version
+from PIL import Image
 # requires diffusers >= 0.36.0
 from diffusers import (
     DiffusionPipeline,
@@ -10,37 +22,193 @@ from diffusers import (
     QwenImageControlNetModel,
     QwenImageControlNetInpaintPipeline
 )
+from diffusers.hooks import FirstBlockCacheConfig, HookRegistry
+from diffusers.hooks import first_block_cache
 
 from ..configs import config
-from ..models.generation import GeneratorOutput, GenerateInput, InpaintInput, TaskType
-from ..utils.common import load_image, image_to_bytes
+from ..models.generation import GeneratorOutput, GenerateInput, InpaintInput, TaskType, ImageFormat
+from ..utils.cache import LRUCache, DiskLRUCache, tensor_nbytes
+from ..utils.common import load_image, image_to_bytes, content_hash
+from ..utils.inpaint import mask_bbox, expand_box, working_size, blend_crop
+from ..utils.metrics import stage_timer
+from .replicas import ReplicaPool
+from .residency import module_nbytes, logger
+from .worker import InferenceWorker, WorkItem
 
 
-class QwenImageGenerator:
-    def __init__(self):
-        self.device = config.device
-        self.torch_dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+# Same default as the pipelines' __call__, which truncates prompt embeddings to this length
+MAX_SEQUENCE_LENGTH = 512
+
+# Older torchao cannot flatten its int8 tensors for safetensors, so the transformer conversion is not attempted
+MIN_TORCHAO_FOR_CONVERSION = Version("0.16.0")
+
+# First-block caching counts its skipped steps by wrapping private diffusers internals: the head block's hook,
+# registered as `_FBC_LEADER_BLOCK_HOOK`, calls its `_should_compute_remaining_blocks(residual)` once per
+# transformer pass to decide whether the remaining blocks run (diffusers 0.35 through at least 0.41). Where that
+# is not the case, cache_threshold is ignored rather than run with a hook we cannot see into.
+FIRST_BLOCK_CACHE_SUPPORTED = (
+    Version(diffusers.__version__) >= Version("0.35.0")
+    and hasattr(first_block_cache, "_FBC_LEADER_BLOCK_HOOK")
+    and callable(getattr(getattr(first_block_cache, "FBCHeadBlockHook", None), "_should_compute_remaining_blocks", None))
+)
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+@dataclass
+class _Generated:
+    """Images of one request as they leave the GPU stage, before encoding."""
+    images: List[Image.Image]
+    cache_skip_ratio: Optional[float] = None
+    # Applied to each image on the encode pool, off the GPU thread (pasting an inpainted crop back)
+    finish: Optional[Callable[[Image.Image], Image.Image]] = None
+
+
+def _create_result_cache() -> DiskLRUCache:
+    return DiskLRUCache(config.result_cache_dir, max_bytes=config.diffusion_result_cache_mb * 1024 * 1024)
+
+
+class QwenImageGenerator(InferenceWorker):
+    model_name = "qwen_image"
+    # Replicas load at the same time, but only one may write the safetensors copy
+    _convert_lock = threading.Lock()
+
+    def __init__(
+            self,
+            device: Optional[str] = None,
+            replica: Optional[int] = None,
+            slot: int = 0,
+            result_cache: Optional[DiskLRUCache] = None
+    ):
+        super().__init__(device, replica, slot)
+        self.torch_dtype = torch.bfloat16 if self.device.startswith("cuda") else torch.float32
+        self.max_batch_size = max(1, config.diffusion_max_batch_size)
+        self.max_batch_wait = config.diffusion_max_batch_wait_ms / 1000
+        # Images (not requests) per batched txt2img pass
+        self.max_batch_images = self.max_batch_size
+        self.max_queue_size = config.diffusion_max_queue_size
+        self.max_queue_wait = config.diffusion_max_queue_wait_s
+        # Both pipelines share the text encoder and prompt template, so one cache serves both
+        self.prompt_cache = LRUCache(
+            max_items=config.diffusion_prompt_cache_size,
+            max_bytes=config.diffusion_prompt_cache_mb * 1024 * 1024
+        )
+        self.prompt_cache_device = self.device if config.diffusion_prompt_cache_on_device else "cpu"
+        # Encoded outputs of seeded requests, one entry per image
+        self.result_cache = result_cache or _create_result_cache()
+        self._model_ids = [
+            config.diffusion_model_id,
+            config.diffusion_orig_model_id,
+            config.diffusion_controlnet_model_id
+        ]
+
+        # Encoding runs here so the GPU thread can start the next job as soon as the images are off the device
+        self._encode_pool = ThreadPoolExecutor(max(1, config.diffusion_encode_workers), thread_name_prefix="encode")
+
+        self.txt2img_pipe: Optional[DiffusionPipeline] = None
+        self.inpaint_pipe: Optional[QwenImageControlNetInpaintPipeline] = None
+
+        self._start_worker()
+
+    def _load_transformer(self):
+        """
+        The int8 checkpoint only ships as a pickle, which has to be deserialized into RAM in full.
+        The first load saves it again as safetensors, so later starts can memory-map the weights.
+        """
+        converted_dir = config.converted_models_dir / config.diffusion_model_id.replace("/", "--")
+        if not config.diffusion_safetensors_conversion:
+            return self._load_pickled_transformer()
+
+        if not (converted_dir / "config.json").exists():
+            skip_reason = self._conversion_skip_reason(converted_dir)
+            if skip_reason:
+                logger.info("Not converting %s to safetensors: %s", config.diffusion_model_id, skip_reason)
+                return self._load_pickled_transformer()
+
+            # Replicas read the pickle side by side; only converting and publishing the copy is serialized
+            transformer = self._load_pickled_transformer()
+            with self._convert_lock:
+                # Another replica may have published the copy, or failed to, while this one was loading
+                if not (converted_dir / "config.json").exists() and not self._conversion_skip_reason(converted_dir):
+                    self._convert_transformer(transformer, converted_dir)
+            return transformer
+
+        try:
+            return AutoModel.from_pretrained(str(converted_dir), torch_dtype=self.torch_dtype, use_safetensors=True)
+        except Exception:
+            # Stale or written by an incompatible version; removed so the next start converts afresh
+            logger.warning("Loading the converted copy of %s failed, loading the original", config.diffusion_model_id, exc_info=True)
+            with self._convert_lock:
+                shutil.rmtree(converted_dir, ignore_errors=True)
+        return self._load_pickled_transformer()
 
-        transformer = AutoModel.from_pretrained(
+    def _load_pickled_transformer(self):
+        return AutoModel.from_pretrained(
             config.diffusion_model_id,
             torch_dtype=self.torch_dtype,
             cache_dir=config.hf_home,
             use_safetensors=False
         )
 
+    @staticmethod
+    def _torchao_version() -> Optional[str]:
+        try:
+            return version("torchao")
+        except PackageNotFoundError:
+            return None
+
+    @classmethod
+    def _conversion_skip_reason(cls, converted_dir) -> Optional[str]:
+        torchao_version = cls._torchao_version()
+        if torchao_version is None or Version(torchao_version) < MIN_TORCHAO_FOR_CONVERSION:
+            return f"needs torchao >= {MIN_TORCHAO_FOR_CONVERSION}, found {torchao_version or 'none'}"
+        failed_marker = converted_dir.with_name(converted_dir.name + ".failed")
+        if failed_marker.exists() and failed_marker.read_text().strip() == torchao_version:
+            # A new torchao version gets another try
+            return f"it failed before with torchao {torchao_version}"
+        return None
+
+    @classmethod
+    def _convert_transformer(cls, transformer, converted_dir):
+        tmp_dir = converted_dir.with_name(converted_dir.name + ".tmp")
+        failed_marker = converted_dir.with_name(converted_dir.name + ".failed")
+        started = time.monotonic()
+        try:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            transformer.save_pretrained(tmp_dir, safe_serialization=True)
+            # Published under the final name only once complete, so an interrupted save is never loaded
+            tmp_dir.rename(converted_dir)
+        except Exception:
+            # Keep loading the pickle, and don't pay for another failed save on every start
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.warning("Converting %s to safetensors failed", config.diffusion_model_id, exc_info=True)
+            try:
+                failed_marker.parent.mkdir(parents=True, exist_ok=True)
+                failed_marker.write_text(cls._torchao_version() or "")
+            except OSError:
+                pass
+            return
+        failed_marker.unlink(missing_ok=True)
+        logger.info("Converted %s to safetensors in %.1fs", config.diffusion_model_id, time.monotonic() - started)
+
+    def _load_model(self):
+        transformer = self._load_transformer()
+
         self.txt2img_pipe = DiffusionPipeline.from_pretrained(
             config.diffusion_orig_model_id,
             transformer=transformer,
             torch_dtype=self.torch_dtype,
             cache_dir=config.hf_home
-        ).to(self.device)
+        )
         self.txt2img_pipe.enable_vae_tiling()
 
         controlnet = QwenImageControlNetModel.from_pretrained(
             config.diffusion_controlnet_model_id,
             torch_dtype=self.torch_dtype,
             cache_dir=config.hf_home
-        ).to(self.device)
+        )
 
         self.inpaint_pipe = QwenImageControlNetInpaintPipeline(
             vae=self.txt2img_pipe.vae,
@@ -49,102 +217,435 @@ class QwenImageGenerator:
             transformer=self.txt2img_pipe.transformer,
             controlnet=controlnet,
             scheduler=self.txt2img_pipe.scheduler,
-        ).to(self.device)
+        )
 
-        self._queue = queue.Queue()
-        self._stop_event = threading.Event()
+    def _move_model(self, device: str):
+        if device != self.device and self.prompt_cache_device != "cpu":
+            # Cached embeddings on the device would pin memory the offload is meant to free
+            self.prompt_cache.clear()
+        # The inpaint pipeline holds every txt2img component plus the ControlNet
+        self.inpaint_pipe.to(device)
 
-        self._worker_thread = threading.Thread(target=self._inference_worker, daemon=True)
-        self._worker_thread.start()
+    def _model_nbytes(self) -> int:
+        return module_nbytes(self.inpaint_pipe)
 
-    def _inference_worker(self):
-        while not self._stop_event.is_set():
-            try:
-                task_type, input_data, result_queue = self._queue.get(timeout=0.1)
-            except queue.Empty:
-                continue
+    def _process_batch(self, batch: List[WorkItem]):
+        groups = {}
+        for item in batch:
+            if item.task_type == TaskType.GENERATE:
+                groups.setdefault(self._batch_key(item.input_data), []).append(item)
+            else:
+                self._run_single(item)
 
-            try:
-                if task_type == TaskType.GENERATE:
-                    result = self._process_generate(input_data)
-                else:
-                    result = self._process_inpaint(input_data)
-                result_queue.put(("success", result))
-            except Exception as e:
-                result_queue.put(("error", str(e)))
-            finally:
-                self._queue.task_done()
-
-    def _process_generate(self, input_data: GenerateInput) -> GeneratorOutput:
-        generator = None
-        if input_data.seed is not None:
-            generator = torch.Generator(device=self.device).manual_seed(input_data.seed)
+        for group in groups.values():
+            for chunk in self._split_by_images(group):
+                if len(chunk) == 1:
+                    self._run_single(chunk[0])
+                    continue
+
+                try:
+                    outputs = self.memory_manager.run(self._process_generate, chunk)
+                except GenerationCancelled:
+                    # Every client in the chunk has gone; there is nobody to retry for
+                    continue
+                except Exception:
+                    # Retry one by one so a single bad request does not fail the whole batch
+                    for item in chunk:
+                        if not item.cancelled:
+                            self._run_single(item)
+                    continue
+
+                for item, generated in zip(chunk, outputs):
+                    self._finish(item, generated)
+
+    def _run_single(self, item: WorkItem):
+        try:
+            generated = self.memory_manager.run(self._process_item, item)
+        except Exception as e:
+            item.set_result("error", str(e))
+            return
+        self._finish(item, generated)
+
+    def _finish(self, item: WorkItem, generated: _Generated):
+        self._encode_pool.submit(self._encode_result, item, generated)
+
+    def _encode_result(self, item: WorkItem, generated: _Generated):
+        input_data = item.input_data
+        try:
+            pil_images = generated.images
+            if generated.finish is not None:
+                with stage_timer(self.model_name, "postprocess"):
+                    pil_images = [generated.finish(image) for image in pil_images]
+            with stage_timer(self.model_name, "encode"):
+                images = [
+                    image_to_bytes(image, input_data.output_format.value, input_data.quality, input_data.compress_level)
+                    for image in pil_images
+                ]
+            result = GeneratorOutput(
+                images=images,
+                output_format=input_data.output_format,
+                cache_skip_ratio=generated.cache_skip_ratio
+            )
+        except Exception as e:
+            item.set_result("error", str(e))
+            return
+
+        self._cache_result(item, result)
+        item.set_result("success", result)
+
+    @staticmethod
+    def _batch_key(input_data: GenerateInput) -> tuple:
+        if input_data.cache_threshold:
+            # First-block caching decides skips from the whole batch's residual, so partners would change the pixels
+            return (id(input_data),)
+        # Everything that shapes the shared denoising loop; prompts and seeds may differ per item
+        return (
+            input_data.width,
+            input_data.height,
+            input_data.num_inference_steps,
+            input_data.true_cfg_scale,
+            input_data.cache_threshold
+        )
+
+    def _split_by_images(self, items: List[WorkItem]) -> List[List[WorkItem]]:
+        chunks, chunk, num_images = [], [], 0
+        for item in items:
+            if chunk and num_images + item.input_data.num_images > self.max_batch_images:
+                chunks.append(chunk)
+                chunk, num_images = [], 0
+            chunk.append(item)
+            num_images += item.input_data.num_images
+        chunks.append(chunk)
+        return chunks
 
-        image = self.txt2img_pipe(
-            prompt=input_data.prompt,
-            negative_prompt=input_data.negative_prompt,
-            width=input_data.width,
-            height=input_data.height,
-            num_inference_steps=input_data.num_inference_steps,
-            true_cfg_scale=input_data.true_cfg_scale,
-            generator=generator
-        ).images[0]
+    def _process_item(self, item: WorkItem) -> _Generated:
+        if item.task_type == TaskType.GENERATE:
+            return self._process_generate([item])[0]
+        return self._process_inpaint(item.input_data, self._step_callback([item], item.input_data.num_inference_steps))
 
-        if config.cuda_frequent_empty_cache:
-            gc.collect()
-            torch.cuda.empty_cache()
+    def _result_keys(self, task_type: TaskType, input_data: Union[GenerateInput, InpaintInput]) -> Optional[List[str]]:
+        """
+        Cache keys for each output image, or None when the request is not reproducible.
+        Image i of a seeded request is image 0 of the same request with seed + i, so keys are per image.
+        """
+        if input_data.seed is None or not self.result_cache.enabled:
+            return None
+        if getattr(input_data, "cache_threshold", None) and input_data.num_images > 1:
+            # First-block caching decides skips for the whole batch, so image i differs from seed + i run alone
+            return None
 
-        return GeneratorOutput(image=image_to_bytes(image))
+        description = {
+            "task": task_type.value,
+            "models": self._model_ids,
+            "fields": input_data.model_dump(mode="json", exclude={"seed", "num_images", "control_image", "control_mask"}),
+        }
+        if isinstance(input_data, InpaintInput):
+            description["control_image"] = content_hash(input_data.control_image)
+            description["control_mask"] = content_hash(input_data.control_mask)
 
-    def _process_inpaint(self, input_data: InpaintInput) -> GeneratorOutput:
-        control_image = load_image(input_data.control_image)
-        control_mask = load_image(input_data.control_mask)
+        num_images = getattr(input_data, "num_images", 1)
+        return [
+            content_hash(json.dumps({**description, "seed": input_data.seed + i}, sort_keys=True).encode())
+            for i in range(num_images)
+        ]
+
+    def _cache_result(self, item: WorkItem, result: GeneratorOutput):
+        keys = self._result_keys(item.task_type, item.input_data)
+        if not keys:
+            return
+
+        try:
+            for key, image in zip(keys, result.images):
+                self.result_cache.put(key, image)
+        except OSError:
+            # A full or read-only volume only costs future cache hits, not this response
+            pass
+
+    def _cached_result(self, keys: List[str], output_format: ImageFormat) -> Optional[GeneratorOutput]:
+        images = []
+        for key in keys:
+            image = self.result_cache.get(key)
+            if image is None:
+                return None
+            images.append(image)
+        return GeneratorOutput(images=images, output_format=output_format)
+
+    async def _lookup(self, task_type: TaskType, input_data: Union[GenerateInput, InpaintInput]) -> Optional[GeneratorOutput]:
+        # Inpaint keys hash the full uploads, which would stall the event loop
+        keys = await asyncio.to_thread(self._result_keys, task_type, input_data)
+        # The membership check is in memory, so misses never leave the event loop
+        if not keys or not all(key in self.result_cache for key in keys):
+            return None
+        return await asyncio.to_thread(self._cached_result, keys, input_data.output_format)
+
+    def _step_callback(self, items: List[WorkItem], num_inference_steps: int) -> Callable:
+        started = time.monotonic()
+
+        def callback(pipe, step: int, timestep, callback_kwargs: dict) -> dict:
+            # Abort instead of finishing (and VAE-decoding) images nobody is waiting for
+            if all(item.cancelled for item in items):
+                raise GenerationCancelled("Request cancelled by client")
+
+            # Let waiting detection/segmentation work run between denoising steps
+            self.scheduler.checkpoint()
+
+            done = step + 1
+            elapsed = time.monotonic() - started
+            for item in items:
+                item.emit("progress", {
+                    "step": done,
+                    "total_steps": num_inference_steps,
+                    "elapsed": elapsed,
+                    "eta": elapsed / done * (num_inference_steps - done)
+                })
+            return {}
+
+        return callback
+
+    def _generators(self, seed: Optional[int], num_images: int) -> List[torch.Generator]:
+        generators = []
+        for i in range(num_images):
+            generator = torch.Generator(device=self.device)
+            if seed is None:
+                generator.seed()
+            else:
+                # Variations of a seeded request are reproducible as seed, seed + 1, ...
+                generator.manual_seed(seed + i)
+            generators.append(generator)
+        return generators
+
+    def _encode_prompt(self, text: str) -> tuple:
+        """Returns `(prompt_embeds, prompt_embeds_mask)` on the model device, running the text encoder only on a cache miss."""
+        cached = self.prompt_cache.get(text)
+        if cached is not None:
+            embeds, mask = cached
+            return embeds.to(self.device), mask.to(self.device)
+
+        with torch.no_grad(), stage_timer(self.model_name, "preprocess", self.device):
+            embeds, mask = self.txt2img_pipe.encode_prompt(
+                prompt=text,
+                device=self.device,
+                max_sequence_length=MAX_SEQUENCE_LENGTH
+            )
+
+        # encode_prompt drops an all-ones mask; keep it explicit so the pipelines don't warn about a missing one
+        if mask is None:
+            mask = torch.ones(embeds.shape[:2], dtype=torch.long, device=embeds.device)
+
+        self.prompt_cache.put(
+            text,
+            (embeds.to(self.prompt_cache_device), mask.to(self.prompt_cache_device)),
+            tensor_nbytes(embeds, mask)
+        )
+        return embeds, mask
+
+    def _batched_embeds(self, prompts: List[str], repeats: List[int]) -> tuple:
+        """Encodes each prompt, pads all of them to the longest sequence and repeats each per requested image."""
+        encoded = [self._encode_prompt(prompt) for prompt in prompts]
+        seq_len = max(embeds.shape[1] for embeds, _ in encoded)
+
+        embeds = torch.cat([
+            F.pad(embeds, (0, 0, 0, seq_len - embeds.shape[1])).repeat(count, 1, 1)
+            for (embeds, _), count in zip(encoded, repeats)
+        ])
+        masks = torch.cat([
+            F.pad(mask, (0, seq_len - mask.shape[1])).repeat(count, 1)
+            for (_, mask), count in zip(encoded, repeats)
+        ])
+        return embeds, masks
+
+    def _prompt_kwargs(self, prompts: List[str], negative_prompts: List[str], repeats: List[int], true_cfg_scale: float) -> dict:
+        embeds, mask = self._batched_embeds(prompts, repeats)
+        kwargs = {"prompt_embeds": embeds, "prompt_embeds_mask": mask}
+        # The pipelines only encode the negative prompt when true CFG is on
+        if true_cfg_scale > 1:
+            negative_embeds, negative_mask = self._batched_embeds(negative_prompts, repeats)
+            kwargs["negative_prompt_embeds"] = negative_embeds
+            kwargs["negative_prompt_embeds_mask"] = negative_mask
+        return kwargs
+
+    @contextmanager
+    def _first_block_cache(self, threshold: Optional[float]):
+        """
+        Enables first-block caching on the transformer for one pipeline call and yields counts of the
+        transformer passes that ran all blocks ("computed") or reused the cached residual ("skipped"),
+        or None when caching stays off (no threshold, or see `FIRST_BLOCK_CACHE_SUPPORTED`).
+
+        Only used for txt2img: the ControlNet pipeline adds its residuals between blocks, outside
+        the span the cache replaces, so skipped steps would apply them twice.
+        """
+        if not threshold or not FIRST_BLOCK_CACHE_SUPPORTED:
+            yield None
+            return
+
+        counts = {"computed": 0, "skipped": 0}
+        transformer = self.txt2img_pipe.transformer
+        transformer.enable_cache(FirstBlockCacheConfig(threshold=threshold))
+        try:
+            head_hook = HookRegistry.check_if_exists_or_initialize(transformer.transformer_blocks[0]).get_hook(
+                first_block_cache._FBC_LEADER_BLOCK_HOOK
+            )
+            should_compute = head_hook._should_compute_remaining_blocks
+
+            def counting(hidden_states_residual: torch.Tensor) -> bool:
+                compute = should_compute(hidden_states_residual)
+                counts["computed" if compute else "skipped"] += 1
+                return compute
+
+            head_hook._should_compute_remaining_blocks = counting
+            yield counts
+        finally:
+            transformer.disable_cache()
+
+    def _process_generate(self, items: List[WorkItem]) -> List[_Generated]:
+        """Runs compatible txt2img requests (see `_batch_key`) through one denoising loop."""
+        inputs: List[GenerateInput] = [item.input_data for item in items]
+        first = inputs[0]
+        repeats = [input_data.num_images for input_data in inputs]
+
+        generators = []
+        for input_data in inputs:
+            generators.extend(self._generators(input_data.seed, input_data.num_images))
+
+        with stage_timer(self.model_name, "forward", self.device), self._first_block_cache(first.cache_threshold) as counts:
+            images = self.txt2img_pipe(
+                **self._prompt_kwargs(
+                    [input_data.prompt for input_data in inputs],
+                    [input_data.negative_prompt for input_data in inputs],
+                    repeats,
+                    first.true_cfg_scale
+                ),
+                width=first.width,
+                height=first.height,
+                num_inference_steps=first.num_inference_steps,
+                true_cfg_scale=first.true_cfg_scale,
+                generator=generators,
+                callback_on_step_end=self._step_callback(items, first.num_inference_steps)
+            ).images
+
+        skip_ratio = None
+        if counts is not None:
+            skip_ratio = counts["skipped"] / max(1, counts["computed"] + counts["skipped"])
+
+        results = []
+        offset = 0
+        for count in repeats:
+            results.append(_Generated(images=images[offset:offset + count], cache_skip_ratio=skip_ratio))
+            offset += count
+        return results
+
+    def _process_inpaint(self, input_data: InpaintInput, callback: Optional[Callable] = None) -> _Generated:
+        with stage_timer(self.model_name, "decode"):
+            control_image = load_image(input_data.control_image)
+            control_mask = load_image(input_data.control_mask)
+
+        # Only diffuse the masked region: crop it with some context, inpaint at the working resolution, paste it back
+        box = None
+        if input_data.crop_to_mask:
+            box = mask_bbox(control_mask)
+            if box is None:
+                return _Generated(images=[control_image])
+            box = expand_box(box, input_data.crop_padding, control_image.size)
+
+        if box is not None:
+            width, height = working_size((box[2] - box[0], box[3] - box[1]), input_data.crop_resolution)
+            pipe_image = control_image.crop(box).resize((width, height), Image.Resampling.LANCZOS)
+            pipe_mask = control_mask.crop(box).resize((width, height), Image.Resampling.NEAREST)
+        else:
+            pipe_image, pipe_mask = control_image, control_mask
+            width, height = control_image.size
 
         generator = None
         if input_data.seed is not None:
             generator = torch.Generator(device=self.device).manual_seed(input_data.seed)
 
-        image = self.inpaint_pipe(
-            prompt=input_data.prompt,
-            negative_prompt=input_data.negative_prompt,
-            control_image=control_image,
-            control_mask=control_mask,
-            controlnet_conditioning_scale=input_data.controlnet_conditioning_scale,
-            width=control_image.size[0],
-            height=control_image.size[1],
-            num_inference_steps=input_data.num_inference_steps,
-            true_cfg_scale=input_data.true_cfg_scale,
-            generator=generator
-        ).images[0]
-
-        if config.cuda_frequent_empty_cache:
-            gc.collect()
-            torch.cuda.empty_cache()
-
-        return GeneratorOutput(image=image_to_bytes(image))
-
-    def generate(self, input_data: GenerateInput) -> GeneratorOutput:
-        result_queue = queue.Queue()
-        self._queue.put((TaskType.GENERATE, input_data, result_queue))
-
-        status, result = result_queue.get()
+        with stage_timer(self.model_name, "forward", self.device):
+            image = self.inpaint_pipe(
+                **self._prompt_kwargs([input_data.prompt], [input_data.negative_prompt], [1], input_data.true_cfg_scale),
+                control_image=pipe_image,
+                control_mask=pipe_mask,
+                controlnet_conditioning_scale=input_data.controlnet_conditioning_scale,
+                width=width,
+                height=height,
+                num_inference_steps=input_data.num_inference_steps,
+                true_cfg_scale=input_data.true_cfg_scale,
+                generator=generator,
+                callback_on_step_end=callback
+            ).images[0]
+
+        if box is not None:
+            # Resizing, feathering and pasting the crop back scale with the upload, not the GPU work
+            return _Generated(
+                images=[image],
+                finish=lambda crop: blend_crop(control_image, crop, control_mask, box, input_data.feather)
+            )
+        return _Generated(images=[image])
+
+    async def generate(self, input_data: GenerateInput) -> GeneratorOutput:
+        cached = await self._lookup(TaskType.GENERATE, input_data)
+        if cached is not None:
+            return cached
+
+        status, result = await self._submit(input_data, TaskType.GENERATE)
         if status == "error":
             raise RuntimeError(f"Generation failed: {result}")
 
         return result
 
-    def inpaint(self, input_data: InpaintInput) -> GeneratorOutput:
-        result_queue = queue.Queue()
-        self._queue.put((TaskType.INPAINT, input_data, result_queue))
+    async def inpaint(self, input_data: InpaintInput) -> GeneratorOutput:
+        cached = await self._lookup(TaskType.INPAINT, input_data)
+        if cached is not None:
+            return cached
 
-        status, result = result_queue.get()
+        status, result = await self._submit(input_data, TaskType.INPAINT)
         if status == "error":
             raise RuntimeError(f"Inpainting failed: {result}")
 
         return result
 
+    async def generate_stream(self, input_data: GenerateInput) -> AsyncIterator[tuple]:
+        return await self._stream(input_data, TaskType.GENERATE)
+
+    async def inpaint_stream(self, input_data: InpaintInput) -> AsyncIterator[tuple]:
+        return await self._stream(input_data, TaskType.INPAINT)
+
+    async def _stream(self, input_data: Union[GenerateInput, InpaintInput], task_type: TaskType) -> AsyncIterator[tuple]:
+        """Admits the request and returns its event iterator; awaiting it raises `QueueFullError` like `_submit_stream`."""
+        keys = await asyncio.to_thread(self._result_keys, task_type, input_data)
+        if keys and all(key in self.result_cache for key in keys):
+            # Read before returning: if an entry was evicted since the membership check, the request is
+            # admitted below like any other, and a full queue is still a 429 rather than a failed stream
+            result = await asyncio.to_thread(self._cached_result, keys, input_data.output_format)
+            if result is not None:
+                return self._cached_stream(result)
+        return self._submit_stream(input_data, task_type)
+
+    @staticmethod
+    async def _cached_stream(result: GeneratorOutput) -> AsyncIterator[tuple]:
+        yield "result", ("success", result)
+
     def stop(self):
-        self._stop_event.set()
-        self._worker_thread.join()
+        super().stop()
+        self._encode_pool.shutdown(wait=True)
+        self.prompt_cache.clear()
         del self.txt2img_pipe, self.inpaint_pipe
         torch.cuda.empty_cache()
+
+
+class QwenImageGeneratorPool(ReplicaPool[QwenImageGenerator]):
+    def __init__(self):
+        # One cache directory, so every replica serves the seeded results any of them produced
+        self.result_cache = _create_result_cache()
+        super().__init__(partial(QwenImageGenerator, result_cache=self.result_cache), config.diffusion_devices)
+
+    async def generate(self, input_data: GenerateInput) -> GeneratorOutput:
+        return await self.pick().generate(input_data)
+
+    async def inpaint(self, input_data: InpaintInput) -> GeneratorOutput:
+        return await self.pick().inpaint(input_data)
+
+    async def generate_stream(self, input_data: GenerateInput) -> AsyncIterator[tuple]:
+        return await self.pick().generate_stream(input_data)
+
+    async def inpaint_stream(self, input_data: InpaintInput) -> AsyncIterator[tuple]:
+        return await self.pick().inpaint_stream(input_data)
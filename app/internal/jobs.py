@@ -0,0 +1,148 @@
+import io
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from pathlib import Path
+from typing import Dict, Optional
+
+from ..models.generation import TaskType, GeneratorOutput
+from ..models.jobs import JobRecord, JobStatus
+
+
+class JobStore:
+    """
+    Keeps job records and results under `root`, one directory per job.
+
+    Records live in memory while the process runs and are written to disk on every status
+    change, so finished results survive client disconnects and can be fetched until `ttl`
+    seconds after the job finished.
+    """
+
+    def __init__(self, root: Path, ttl: float):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self._records: Dict[str, JobRecord] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _valid_id(job_id: str) -> bool:
+        try:
+            return uuid.UUID(hex=job_id).hex == job_id
+        except ValueError:
+            return False
+
+    def _job_dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    def _write_record(self, record: JobRecord):
+        job_dir = self._job_dir(record.id)
+        job_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = job_dir / "job.json.tmp"
+        tmp_path.write_text(record.model_dump_json())
+        os.replace(tmp_path, job_dir / "job.json")
+
+    def create(self, task_type: TaskType) -> JobRecord:
+        now = time.time()
+        record = JobRecord(id=uuid.uuid4().hex, task_type=task_type, created_at=now, updated_at=now)
+        with self._lock:
+            self._records[record.id] = record
+        self._write_record(record)
+        return record
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        if not self._valid_id(job_id):
+            return None
+
+        with self._lock:
+            record = self._records.get(job_id)
+        if record is not None:
+            return record
+
+        # Finished jobs from an earlier process, or evicted from memory
+        path = self._job_dir(job_id) / "job.json"
+        if not path.exists():
+            return None
+        return JobRecord.model_validate_json(path.read_text())
+
+    def update(self, record: JobRecord, persist: bool = True, **changes):
+        """Applies `changes` to the record; progress-only updates skip the disk write."""
+        with self._lock:
+            for key, value in changes.items():
+                setattr(record, key, value)
+            record.updated_at = time.time()
+        if persist:
+            self._write_record(record)
+
+    def save_result(self, record: JobRecord, result: GeneratorOutput):
+        if len(result.images) == 1:
+            content, media_type = result.image, result.media_type
+        else:
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+                for i, image_bytes in enumerate(result.images):
+                    zf.writestr(f'{i}.{result.extension}', image_bytes)
+            content, media_type = buf.getvalue(), "application/zip"
+
+        tmp_path = self._job_dir(record.id) / "result.tmp"
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, self.result_path(record.id))
+
+        self.update(
+            record,
+            status=JobStatus.SUCCEEDED,
+            media_type=media_type,
+            queue_position=None
+        )
+        self._forget(record.id)
+
+    def fail(self, record: JobRecord, error: str):
+        self.update(record, status=JobStatus.FAILED, error=error, queue_position=None)
+        self._forget(record.id)
+
+    def discard(self, record: JobRecord):
+        """Removes a job whose work was never queued, as if it had not been created."""
+        self._forget(record.id)
+        shutil.rmtree(self._job_dir(record.id), ignore_errors=True)
+
+    def result_path(self, job_id: str) -> Path:
+        return self._job_dir(job_id) / "result"
+
+    def _forget(self, job_id: str):
+        # Finished records are served from disk from now on
+        with self._lock:
+            self._records.pop(job_id, None)
+
+    def recover(self):
+        """Marks jobs a previous process left queued or running as failed; their work items are gone."""
+        for path in self.root.glob("*/job.json"):
+            try:
+                record = JobRecord.model_validate_json(path.read_text())
+            except ValueError:
+                continue
+            if not record.finished:
+                self.fail(record, "Interrupted by a server restart")
+
+    def cleanup(self) -> int:
+        """Deletes finished jobs older than the TTL; returns how many were removed."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for job_dir in self.root.iterdir():
+            path = job_dir / "job.json"
+            try:
+                record = JobRecord.model_validate_json(path.read_text())
+            except (OSError, ValueError):
+                # Half-written or foreign directory; judge it by age alone
+                if job_dir.is_dir() and job_dir.stat().st_mtime < cutoff:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    removed += 1
+                continue
+
+            if record.finished and record.updated_at < cutoff:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed += 1
+        return removed
@@ -1,91 +1,260 @@
-import gc
-import queue
-import threading
+import asyncio
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
 
 import torch
 from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
-from transformers.image_utils import load_image
+from transformers.modeling_outputs import BaseModelOutput
 
 from ..configs import config
-from ..models.object_detection import DetectorInput, DetectionResult, DetectorOutput
-from ..utils.common import load_image as load_pil_image
+from ..models.object_detection import DetectorInput, DetectorBatchInput, DetectionResult, DetectorOutput
+from ..utils.cache import LRUCache, tensor_nbytes
+from ..utils.common import load_image, full_size
+from ..utils.memory import pinned
+from ..utils.metrics import stage_timer
+from .replicas import ReplicaPool
+from .residency import module_nbytes
+from .worker import InferenceWorker, WorkItem
 
 
-class GDinoDetector:
-    def __init__(self):
+class _TextFeatures:
+    """Tokenized label set, plus the text backbone output once it has been computed."""
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.hidden_state: Optional[torch.Tensor] = None
+
+    @property
+    def nbytes(self) -> int:
+        tensors = list(self.inputs.values())
+        if self.hidden_state is not None:
+            tensors.append(self.hidden_state)
+        return tensor_nbytes(*tensors)
+
+
+class _CachedTextBackbone(torch.nn.Module):
+    """Wraps the text backbone so a known label set skips the BERT forward pass."""
+
+    def __init__(self, backbone: torch.nn.Module):
+        super().__init__()
+        self.backbone = backbone
+        self.active: Optional[_TextFeatures] = None
+
+    def forward(self, input_ids, *args, **kwargs):
+        features = self.active
+        if features is None:
+            return self.backbone(input_ids, *args, **kwargs)
+
+        if features.hidden_state is None:
+            outputs = self.backbone(input_ids, *args, **kwargs)
+            # Every row of a batch carries the same label set, so one row is enough to cache; cloned,
+            # since a view would keep the whole batch's storage alive behind a one-row `nbytes`
+            features.hidden_state = outputs[0][:1].clone()
+            return outputs
+
+        return BaseModelOutput(last_hidden_state=features.hidden_state.expand(input_ids.shape[0], -1, -1))
+
+
+@dataclass
+class _Prepared:
+    """One request after CPU preprocessing, then with the forward pass outputs moved back to the CPU."""
+    work_item: WorkItem
+    inputs: dict
+    text_key: tuple
+    text_features: _TextFeatures
+    is_new: bool
+    # Height and width of each upload, which boxes are scaled to
+    target_sizes: List[Tuple[int, int]]
+    outputs: Optional[object] = None
+
+
+class GDinoDetector(InferenceWorker):
+    task_type = "detect"
+    model_name = "gdino"
+
+    def __init__(self, device: Optional[str] = None, replica: Optional[int] = None, slot: int = 0):
+        super().__init__(device, replica, slot)
         self.model_id = config.gdino_model_id
-        self.device = config.device
+        self.processor = None
+        self.model = None
+        # Shorter side the processor resizes to; larger JPEGs are decoded at reduced size
+        self.decode_min_size: Optional[int] = None
+        self._text_backbone: Optional[_CachedTextBackbone] = None
+
+        self.text_cache = LRUCache(
+            max_items=config.gdino_text_cache_size,
+            max_bytes=config.gdino_text_cache_mb * 1024 * 1024
+        )
+        self.batch_chunk_size = max(1, config.gdino_batch_chunk_size)
+        self.max_queue_size = config.gdino_max_queue_size
+        self.max_queue_wait = config.gdino_max_queue_wait_s
+        self.preprocess_workers = config.gdino_preprocess_workers
+        self.postprocess_workers = config.gdino_postprocess_workers
+
+        self._start_worker()
+
+    def _load_model(self):
         self.processor = AutoProcessor.from_pretrained(self.model_id, cache_dir=config.hf_home)
-        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(
-            self.model_id,
-            cache_dir=config.hf_home
-        ).to(self.device)
+        self.decode_min_size = self.processor.image_processor.size.get("shortest_edge")
+        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(self.model_id, cache_dir=config.hf_home)
         self.model.eval()
+        self._text_backbone = _CachedTextBackbone(self.model.model.text_backbone)
+        self.model.model.text_backbone = self._text_backbone
 
-        self._queue = queue.Queue()
-        self._stop_event = threading.Event()
+    def _move_model(self, device: str):
+        if device != self.device:
+            # Cached text features live on the device and would pin memory the offload is meant to free
+            self.text_cache.clear()
+        self.model.to(device)
 
-        self._worker_thread = threading.Thread(target=self._inference_worker, daemon=True)
-        self._worker_thread.start()
+    def _model_nbytes(self) -> int:
+        return module_nbytes(self.model)
 
-    def _inference_worker(self):
-        while not self._stop_event.is_set():
-            try:
-                input_data, result_queue = self._queue.get(timeout=0.1)
-            except queue.Empty:
-                continue
+    @staticmethod
+    def _text_key(text: List[str]) -> tuple:
+        # Same normalization the processor applies before merging labels into "a cat. a dog."
+        return tuple(label.strip().lower() for label in text)
+
+    def _get_text_features(self, text: List[str]) -> tuple:
+        key = self._text_key(text)
+        features = self.text_cache.get(key)
+        if features is not None:
+            return key, features, False
 
+        inputs = self.processor(text=[list(key)], return_tensors="pt").to(self.device)
+        return key, _TextFeatures(inputs), True
+
+    def _preprocess_batch(self, batch: List[WorkItem]) -> List[_Prepared]:
+        prepared = []
+        for work_item in batch:
             try:
-                result = self._process(input_data)
-                result_queue.put(("success", result))
+                prepared.append(self._prepare(work_item))
             except Exception as e:
-                result_queue.put(("error", str(e)))
-            finally:
-                self._queue.task_done()
-
-    def _process(self, input_data: DetectorInput) -> DetectorOutput:
-        image = load_image(load_pil_image(input_data.image))
+                work_item.set_result("error", str(e))
+        return prepared
 
-        text_labels = [input_data.text]
+    def _prepare(self, work_item: WorkItem) -> _Prepared:
+        input_data: Union[DetectorInput, DetectorBatchInput] = work_item.input_data
+        with stage_timer(self.model_name, "decode"):
+            if isinstance(input_data, DetectorBatchInput):
+                images = [load_image(image, self.decode_min_size) for image in input_data.images]
+            else:
+                images = [load_image(input_data.image, self.decode_min_size)]
 
-        inputs = self.processor(images=image, text=text_labels, return_tensors="pt").to(self.device)
+        with stage_timer(self.model_name, "preprocess"):
+            text_key, text_features, is_new = self._get_text_features(input_data.text)
 
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+            # The image processor pads the batch to a common size and returns the matching pixel_mask
+            inputs = self.processor(images=images, return_tensors="pt")
+            inputs = {key: pinned(value, self.device) for key, value in inputs.items()}
 
-        results = self.processor.post_process_grounded_object_detection(
-            outputs,
-            threshold=input_data.threshold,
-            target_sizes=[(image.height, image.width)]
+        return _Prepared(
+            work_item=work_item,
+            inputs=inputs,
+            text_key=text_key,
+            text_features=text_features,
+            is_new=is_new,
+            # Boxes are relative to the upload, not to a reduced-size decode
+            target_sizes=[full_size(image)[::-1] for image in images]
         )
 
-        detections = []
-        for result in results:
-            detection = DetectionResult(
-                boxes=result["boxes"].cpu().tolist(),
-                scores=result["scores"].cpu().tolist(),
-                labels=result["labels"]
+    def _forward_batch(self, batch: List[WorkItem], prepared: List[_Prepared]) -> List[_Prepared]:
+        done = []
+        for item in prepared:
+            try:
+                self.memory_manager.run(self._forward, item)
+            except Exception as e:
+                item.work_item.set_result("error", str(e))
+                continue
+            done.append(item)
+        return done
+
+    def _forward(self, item: _Prepared):
+        num_images = len(item.target_sizes)
+        text_inputs = {key: value.repeat(num_images, 1) for key, value in item.text_features.inputs.items()}
+        inputs = {key: value.to(self.device, non_blocking=True) for key, value in item.inputs.items()}
+
+        self._text_backbone.active = item.text_features
+        try:
+            with torch.no_grad(), stage_timer(self.model_name, "forward", self.device):
+                outputs = self.model(**inputs, **text_inputs)
+                # Only what post-processing reads, so the rest of the outputs can leave the device now
+                item.outputs = type(outputs)(logits=outputs.logits.cpu(), pred_boxes=outputs.pred_boxes.cpu())
+        finally:
+            self._text_backbone.active = None
+
+        if item.is_new:
+            self.text_cache.put(item.text_key, item.text_features, item.text_features.nbytes)
+
+    def _postprocess_batch(self, batch: List[WorkItem], prepared: List[_Prepared]):
+        for item in prepared:
+            try:
+                item.work_item.set_result("success", self._postprocess_detections(item))
+            except Exception as e:
+                item.work_item.set_result("error", str(e))
+
+    def _postprocess_detections(self, item: _Prepared) -> DetectorOutput:
+        num_images = len(item.target_sizes)
+        with stage_timer(self.model_name, "postprocess"):
+            results = self.processor.post_process_grounded_object_detection(
+                item.outputs,
+                input_ids=item.text_features.inputs["input_ids"].cpu().repeat(num_images, 1),
+                threshold=item.work_item.input_data.threshold,
+                target_sizes=item.target_sizes
             )
-            detections.append(detection)
 
-        if config.cuda_frequent_empty_cache:
-            gc.collect()
-            torch.cuda.empty_cache()
+            detections = []
+            for result in results:
+                detection = DetectionResult(
+                    boxes=result["boxes"].tolist(),
+                    scores=result["scores"].tolist(),
+                    labels=result["labels"]
+                )
+                detections.append(detection)
 
         return DetectorOutput(detections=detections)
 
-    def detect(self, input_data: DetectorInput) -> DetectorOutput:
-        result_queue = queue.Queue()
-        self._queue.put((input_data, result_queue))
-
-        status, result = result_queue.get()
+    async def detect(self, input_data: DetectorInput) -> DetectorOutput:
+        status, result = await self._submit(input_data)
         if status == "error":
             raise RuntimeError(f"Detection failed: {result}")
 
         return result
 
+    async def detect_batch(self, input_data: DetectorBatchInput) -> DetectorOutput:
+        chunks = [
+            DetectorBatchInput(
+                images=input_data.images[i:i + self.batch_chunk_size],
+                text=input_data.text,
+                threshold=input_data.threshold
+            )
+            for i in range(0, len(input_data.images), self.batch_chunk_size)
+        ]
+
+        # Admit the whole upload up front rather than queueing part of it
+        self._admit(len(chunks))
+
+        detections = []
+        for status, result in await asyncio.gather(*(self._submit(chunk, admit=False) for chunk in chunks)):
+            if status == "error":
+                raise RuntimeError(f"Detection failed: {result}")
+            detections.extend(result.detections)
+
+        return DetectorOutput(detections=detections)
+
     def stop(self):
-        self._stop_event.set()
-        self._worker_thread.join()
+        super().stop()
+        self.text_cache.clear()
         del self.model, self.processor
         torch.cuda.empty_cache()
+
+
+class GDinoDetectorPool(ReplicaPool[GDinoDetector]):
+    def __init__(self):
+        super().__init__(GDinoDetector, config.gdino_devices)
+
+    async def detect(self, input_data: DetectorInput) -> DetectorOutput:
+        return await self.pick().detect(input_data)
+
+    async def detect_batch(self, input_data: DetectorBatchInput) -> DetectorOutput:
+        return await self.pick().detect_batch(input_data)
@@ -0,0 +1,104 @@
+import itertools
+from typing import Callable, Generic, List, Optional, TypeVar
+
+from ..utils.memory import normalize_device
+from .worker import InferenceWorker
+
+W = TypeVar("W", bound=InferenceWorker)
+
+
+class ReplicaPool(Generic[W]):
+    """
+    Replicas of one model, one per entry of its device list, each with its own copy of the
+    weights, queue and worker thread.
+
+    `pick` sends a new request to the replica expected to finish it soonest: outstanding items
+    times the replica's average service time, then fewest outstanding items, then round robin,
+    so replicas that have not measured a service time yet still share the load. A replica
+    matching `prefer` (one that already has the request's image embedding, say) is chosen
+    instead when that costs at most one of its own service times.
+    """
+
+    def __init__(self, factory: Callable[..., W], devices: List[str]):
+        if not devices:
+            raise ValueError("A replica pool needs at least one device")
+
+        # "cuda" and "cuda:0" are the same GPU, so they share scheduler slots
+        devices = [normalize_device(device) for device in devices]
+        self.replicas: List[W] = []
+        for index, device in enumerate(devices):
+            self.replicas.append(factory(
+                device=device,
+                # A single replica keeps the plain model name in residency stats
+                replica=index if len(devices) > 1 else None,
+                # Replicas listed on the same device get their own scheduler slot there
+                slot=devices[:index].count(device)
+            ))
+        self._turn = itertools.count()
+
+    @property
+    def primary(self) -> W:
+        return self.replicas[0]
+
+    @property
+    def decode_min_size(self) -> Optional[int]:
+        """
+        Smallest shorter side worth decoding an upload at for this model, or None before a replica has
+        loaded its processor (or for models that do not reduce uploads). Every replica uses the same
+        processor, so any that has loaded it knows the size.
+        """
+        sizes = (getattr(replica, "decode_min_size", None) for replica in self.replicas)
+        return next((size for size in sizes if size), None)
+
+    @staticmethod
+    def _expected_finish(replica: W) -> float:
+        return (replica.outstanding + 1) * (replica.service_time or 0.0)
+
+    def pick(self, prefer: Optional[Callable[[W], bool]] = None) -> W:
+        if len(self.replicas) == 1:
+            return self.replicas[0]
+
+        # Called on the event loop, where the chosen replica's count goes up before the next pick
+        turn = next(self._turn)
+        count = len(self.replicas)
+        best = min(
+            range(count),
+            key=lambda i: (
+                self._expected_finish(self.replicas[i]),
+                self.replicas[i].outstanding,
+                (i - turn) % count
+            )
+        )
+        chosen = self.replicas[best]
+
+        if prefer is not None and not prefer(chosen):
+            preferred = [replica for replica in self.replicas if prefer(replica)]
+            if preferred:
+                replica = min(preferred, key=self._expected_finish)
+                margin = replica.service_time or 0.0
+                if self._expected_finish(replica) <= self._expected_finish(chosen) + margin:
+                    return replica
+        return chosen
+
+    def queue_stats(self) -> dict:
+        """The single-worker `queue_stats` fields summed over replicas, plus one entry per replica."""
+        replicas = [
+            {"name": replica.replica_name, "device": replica.device, "outstanding": replica.outstanding, **replica.queue_stats()}
+            for replica in self.replicas
+        ]
+        service_times = [r["service_time"] for r in replicas if r["service_time"] is not None]
+        return {
+            "depth": sum(r["depth"] for r in replicas),
+            "in_flight": sum(r["in_flight"] for r in replicas),
+            "max_size": self.primary.max_queue_size,
+            "max_wait": self.primary.max_queue_wait,
+            "service_time": min(service_times) if service_times else None,
+            # What a new request would face on the replica it is sent to
+            "estimated_wait": min(r["estimated_wait"] for r in replicas),
+            "utilization": sum(r["utilization"] for r in replicas) / len(replicas),
+            "replicas": replicas,
+        }
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.stop()
@@ -0,0 +1,329 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+
+from ..configs import config
+from ..utils.memory import memory_manager_for
+from ..utils.metrics import registry
+
+RESIDENCY_EVENTS = registry.counter(
+    "model_residency_events_total",
+    "Model loads, moves to the device and offloads to CPU memory",
+    ["model", "event", "reason"]
+)
+
+# uvicorn only configures its own loggers, so startup timings go through them
+logger = logging.getLogger("uvicorn.error")
+
+
+def module_nbytes(*objects) -> int:
+    """Parameter and buffer bytes of modules or diffusers pipelines, counting shared tensors once."""
+    seen, total = set(), 0
+    for obj in objects:
+        components = getattr(obj, "components", None)
+        modules = components.values() if isinstance(components, dict) else [obj]
+        for module in modules:
+            if not isinstance(module, torch.nn.Module):
+                continue
+            for tensor in (*module.parameters(), *module.buffers()):
+                if id(tensor) not in seen:
+                    seen.add(id(tensor))
+                    total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class _Resident:
+    def __init__(self, worker):
+        self.worker = worker
+        # "unloaded", "cpu" or "device", or "to_device" / "offloading" while a transfer is under way
+        self.state = "unloaded"
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.load_lock = threading.Lock()
+        # Seconds per startup phase ("load", "to_device"), plus "error" if startup failed
+        self.startup: Optional[dict] = None
+        self.startup_done = False
+
+
+class ResidencyManager:
+    """
+    Decides which models occupy the device.
+
+    Workers register themselves under their `replica_name` and implement `_load_model` (build
+    the model in CPU memory), `_move_model(device)` and `_model_nbytes`; each is brought to its
+    own `device`. With `lazy`, a model is only loaded when its
+    worker picks up the first request; otherwise registration starts loading it in the
+    background, up to `load_concurrency` models at a time, and requests that arrive before it
+    is ready wait in their worker's queue. Models idle for `idle_timeout` seconds are moved
+    back to CPU memory, and bringing a model to its device offloads the least recently used idle models there first
+    when the device's resident total would exceed `budget` bytes. 0 disables either limit.
+
+    Transfers take seconds for large models, so they never run under the manager's lock: a model
+    is claimed with a transitional state under the lock, moved without it, and the outcome is
+    committed under the lock again. Only requests for a model in transit wait for it.
+    """
+
+    def __init__(
+            self,
+            budget: int,
+            idle_timeout: float,
+            lazy: bool,
+            load_concurrency: int = 1,
+            max_events: int = 100
+    ):
+        self.budget = budget
+        self.idle_timeout = idle_timeout
+        self.lazy = lazy
+        self.load_concurrency = max(1, load_concurrency)
+
+        self._models: Dict[str, _Resident] = {}
+        self._events = deque(maxlen=max_events)
+        self._lock = threading.RLock()
+        # Notified whenever a transfer finishes
+        self._moved = threading.Condition(self._lock)
+        self._sweeper: Optional[threading.Thread] = None
+        self._loader: Optional[ThreadPoolExecutor] = None
+        self._startup_began: Optional[float] = None
+        self._startup_seconds: Optional[float] = None
+
+    def register(self, worker):
+        with self._lock:
+            resident = self._models[worker.replica_name] = _Resident(worker)
+            if self.idle_timeout > 0 and self._offloads(worker) and self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, daemon=True)
+                self._sweeper.start()
+
+            if not self.lazy:
+                if self._loader is None:
+                    self._loader = ThreadPoolExecutor(self.load_concurrency, thread_name_prefix="model-load")
+                if self._startup_began is None or self._startup_seconds is not None:
+                    self._startup_began, self._startup_seconds = time.monotonic(), None
+                resident.startup = {}
+                self._loader.submit(self._startup_load, resident)
+
+    def _startup_load(self, resident: _Resident):
+        name = resident.worker.replica_name
+        try:
+            with self.use(name, reason="startup"):
+                pass
+        except Exception as e:
+            # Left unloaded; the first request tries again
+            resident.startup["error"] = str(e)
+            logger.exception("Loading %s failed", name)
+        else:
+            logger.info(
+                "Loaded %s in %.1fs (read %.1fs, to %s %.1fs)",
+                name,
+                sum(resident.startup.values()),
+                resident.startup.get("load", 0.0),
+                resident.worker.device,
+                resident.startup.get("to_device", 0.0)
+            )
+
+        with self._lock:
+            resident.startup_done = True
+            if self.ready and self._startup_seconds is None:
+                self._startup_seconds = time.monotonic() - self._startup_began
+                logger.info("Model startup finished in %.1fs", self._startup_seconds)
+
+    @property
+    def ready(self) -> bool:
+        """False while any model is still in its startup load."""
+        with self._lock:
+            return all(resident.startup is None or resident.startup_done for resident in self._models.values())
+
+    @staticmethod
+    def _offloads(worker) -> bool:
+        # A model on the CPU frees nothing by moving around
+        return worker.device != "cpu"
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._models.pop(name, None)
+
+    def _record(self, resident: _Resident, event: str, reason: str, seconds: float):
+        name = resident.worker.replica_name
+        if reason == "startup" and resident.startup is not None:
+            resident.startup[event] = round(seconds, 3)
+        self._events.append({
+            "time": time.time(),
+            "model": name,
+            "event": event,
+            "reason": reason,
+            "seconds": round(seconds, 3),
+        })
+        RESIDENCY_EVENTS.inc(model=name, event=event, reason=reason)
+
+    def load(self, name: str, reason: str = "request"):
+        """
+        Builds the model in CPU memory if it has not been loaded yet. Called by the worker thread
+        before a batch is handed to the GPU scheduler, so reading weights never blocks the device.
+        """
+        resident = self._models[name]
+        with resident.load_lock:
+            if resident.state != "unloaded":
+                return
+            started = time.monotonic()
+            resident.worker._load_model()
+            resident.nbytes = resident.worker._model_nbytes()
+            resident.state = "cpu"
+            self._record(resident, "load", reason, time.monotonic() - started)
+
+    @contextmanager
+    def use(self, name: str, reason: str = "request"):
+        """Keeps the model on the device while the block runs; no offload can pick it in the meantime."""
+        self.load(name, reason)
+        resident = self._models[name]
+        with self._lock:
+            while resident.state in ("to_device", "offloading"):
+                self._moved.wait()
+            # Counted from here on, so neither the budget nor the idle sweep picks it while it moves in
+            resident.in_use += 1
+            victims = None
+            if resident.state != "device":
+                victims = self._claim_room(resident.worker.device, resident.nbytes, exclude=name)
+                resident.state = "to_device"
+
+        try:
+            if victims is not None:
+                self._to_device(resident, victims, reason)
+            yield
+        finally:
+            with self._lock:
+                resident.in_use -= 1
+                resident.last_used = time.monotonic()
+
+    def _to_device(self, resident: _Resident, victims: list, reason: str):
+        # Called without the lock, on a resident claimed as "to_device"
+        for victim in victims:
+            try:
+                self._offload(victim, "budget")
+            except Exception:
+                logger.exception("Offloading %s failed", victim.worker.replica_name)
+
+        try:
+            started = time.monotonic()
+            resident.worker._move_model(resident.worker.device)
+        except BaseException:
+            with self._lock:
+                resident.state = "cpu"
+                self._moved.notify_all()
+            raise
+
+        with self._lock:
+            resident.state = "device"
+            self._record(resident, "to_device", reason, time.monotonic() - started)
+            self._moved.notify_all()
+
+    def _claim_room(self, device: str, nbytes: int, exclude: str) -> list:
+        """Claims the least recently used idle models on `device` that must go to fit `nbytes` more; caller holds the lock."""
+        if not self.budget or device == "cpu":
+            return []
+        on_device = {
+            n: r for n, r in self._models.items()
+            if r.state in ("device", "to_device") and r.worker.device == device
+        }
+        resident_bytes = sum(r.nbytes for r in on_device.values())
+        candidates = sorted(
+            (r for n, r in on_device.items() if n != exclude and r.state == "device" and not r.in_use),
+            key=lambda r: r.last_used
+        )
+        victims = []
+        for resident in candidates:
+            if resident_bytes + nbytes <= self.budget:
+                break
+            resident.state = "offloading"
+            victims.append(resident)
+            resident_bytes -= resident.nbytes
+        return victims
+
+    def _offload(self, resident: _Resident, reason: str):
+        # Called without the lock, on a resident claimed as "offloading"
+        started = time.monotonic()
+        try:
+            resident.worker._move_model("cpu")
+        except BaseException:
+            # Most likely still where it was
+            with self._lock:
+                resident.state = "device"
+                self._moved.notify_all()
+            raise
+        memory_manager_for(resident.worker.device).trim("offload")
+
+        with self._lock:
+            resident.state = "cpu"
+            self._record(resident, "offload", reason, time.monotonic() - started)
+            self._moved.notify_all()
+
+    def offload_idle(self) -> int:
+        """Moves models unused for `idle_timeout` seconds to CPU memory; returns how many moved."""
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                resident for resident in self._models.values()
+                if (
+                        resident.state == "device"
+                        and self._offloads(resident.worker)
+                        and not resident.in_use
+                        and now - resident.last_used >= self.idle_timeout
+                )
+            ]
+            for resident in idle:
+                resident.state = "offloading"
+
+        moved = 0
+        for resident in idle:
+            try:
+                self._offload(resident, "idle")
+                moved += 1
+            except Exception:
+                logger.exception("Offloading %s failed", resident.worker.replica_name)
+        return moved
+
+    def _sweep_loop(self):
+        interval = min(max(self.idle_timeout / 4, 1.0), 30.0)
+        while True:
+            time.sleep(interval)
+            self.offload_idle()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "startup_seconds": self._startup_seconds,
+                "lazy": self.lazy,
+                "budget": self.budget,
+                "idle_timeout": self.idle_timeout,
+                "resident_bytes": sum(r.nbytes for r in self._models.values() if r.state == "device"),
+                "models": {
+                    name: {
+                        "device": resident.worker.device,
+                        "state": resident.state,
+                        "bytes": resident.nbytes,
+                        "in_use": resident.in_use,
+                        "idle": now - resident.last_used,
+                        "startup": resident.startup,
+                        "depth": resident.worker.queue_depth,
+                        "outstanding": resident.worker.outstanding,
+                        "utilization": resident.worker.utilization(),
+                    }
+                    for name, resident in self._models.items()
+                },
+                "events": list(self._events),
+            }
+
+
+residency_manager = ResidencyManager(
+    budget=config.model_device_budget_mb * 1024 * 1024,
+    idle_timeout=config.model_idle_offload_s,
+    lazy=config.lazy_model_loading,
+    load_concurrency=config.model_load_concurrency
+)
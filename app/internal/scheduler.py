@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional
+
+from ..configs import config
+from ..utils.memory import normalize_device
+
+DEFAULT_PRIORITY = 0
+DEFAULT_WEIGHT = 1.0
+
+
+class _Task:
+    def __init__(self, task_type: str, priority: float, fn: Callable, args: tuple, kwargs: dict):
+        self.task_type = task_type
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class GpuScheduler:
+    """
+    Owns GPU execution for the model workers on one device (see `scheduler_for`).
+
+    Workers keep their own queues and batching, but hand the actual work to `run`, which
+    executes it on the single scheduler thread. Waiting tasks are served by priority (lower
+    first); task types that share a priority take turns in proportion to their weights.
+    Long-running tasks call `checkpoint` between steps, which runs waiting tasks of a higher
+    priority in the gap instead of leaving them queued behind the whole job.
+    """
+
+    def __init__(self, priorities: Dict[str, float], weights: Dict[str, float], preempt_budget: float):
+        self.priorities = priorities
+        self.weights = weights
+        self.preempt_budget = preempt_budget
+
+        self._pending: Dict[str, deque] = {}
+        self._virtual_time: Dict[str, float] = {}
+        self._clock = 0.0
+        # Priorities of the tasks currently executing, outermost first (checkpoints nest)
+        self._running: List[float] = []
+        self._executed: Dict[str, int] = {}
+        self._preempted = 0
+
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._scheduler_loop, daemon=True)
+
+    def priority(self, task_type: str) -> float:
+        return self.priorities.get(task_type, DEFAULT_PRIORITY)
+
+    def run(self, task_type: str, fn: Callable, *args, **kwargs) -> Any:
+        """Runs `fn` on the scheduler thread and blocks until it returns (or re-raises its error)."""
+        if threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+
+        if isinstance(task_type, Enum):
+            task_type = task_type.value
+        task = _Task(task_type, self.priority(task_type), fn, args, kwargs)
+        with self._cond:
+            if not self._thread.is_alive():
+                self._thread.start()
+
+            pending = self._pending.setdefault(task_type, deque())
+            if not pending:
+                # A type that sat idle does not get to bank turns while it was away
+                self._virtual_time[task_type] = max(self._virtual_time.get(task_type, 0.0), self._clock)
+            pending.append(task)
+            self._cond.notify()
+
+        return task.future.result()
+
+    def checkpoint(self):
+        """
+        Called by a running task between steps: runs waiting tasks with a higher priority,
+        for at most `preempt_budget` seconds, then returns so the caller can continue.
+        """
+        if threading.current_thread() is not self._thread or not self._running:
+            return
+
+        deadline = time.monotonic() + self.preempt_budget
+        while time.monotonic() < deadline:
+            with self._cond:
+                task = self._next_task(below=self._running[-1])
+            if task is None:
+                return
+            self._preempted += 1
+            self._execute(task)
+
+    def _next_task(self, below: Optional[float] = None) -> Optional[_Task]:
+        # Caller holds the lock
+        candidates = [
+            task_type for task_type, pending in self._pending.items()
+            if pending and (below is None or self.priority(task_type) < below)
+        ]
+        if not candidates:
+            return None
+
+        task_type = min(candidates, key=lambda t: (self.priority(t), self._virtual_time[t]))
+        self._clock = self._virtual_time[task_type]
+        self._virtual_time[task_type] += 1.0 / max(self.weights.get(task_type, DEFAULT_WEIGHT), 1e-6)
+        return self._pending[task_type].popleft()
+
+    def _scheduler_loop(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task()
+            self._execute(task)
+
+    def _execute(self, task: _Task):
+        if not task.future.set_running_or_notify_cancel():
+            return
+
+        self._running.append(task.priority)
+        try:
+            result = task.fn(*task.args, **task.kwargs)
+        except BaseException as e:
+            task.future.set_exception(e)
+        else:
+            task.future.set_result(result)
+        finally:
+            self._running.pop()
+            self._executed[task.task_type] = self._executed.get(task.task_type, 0) + 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "pending": {task_type: len(pending) for task_type, pending in self._pending.items()},
+                "executed": dict(self._executed),
+                "preempted": self._preempted,
+                "busy": bool(self._running),
+            }
+
+
+_schedulers: Dict[tuple, GpuScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(device: str, slot: int = 0) -> GpuScheduler:
+    """
+    The scheduler of one execution slot on `device`. Workers on the same device and slot share
+    it, so their work is arbitrated by priority; a model that lists a device twice gets a second
+    slot there and runs its replicas side by side.
+    """
+    key = (normalize_device(device), slot)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = _schedulers[key] = GpuScheduler(
+                priorities=config.gpu_task_priorities,
+                weights=config.gpu_task_weights,
+                preempt_budget=config.gpu_preempt_budget_ms / 1000
+            )
+        return scheduler
+
+
+def scheduler_stats() -> dict:
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {
+        device if slot == 0 else f"{device}#{slot}": scheduler.stats()
+        for (device, slot), scheduler in schedulers.items()
+    }
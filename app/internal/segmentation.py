@@ -1,100 +1,287 @@
-import gc
-import io
-import queue
-import threading
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Union
 
 import torch
 from PIL import Image
 from transformers import Sam2Model, Sam2Processor
 
 from ..configs import config
-from ..models.segmentation import SegmenterInput, SegmenterOutput
-from ..utils.common import load_image
+from ..models.segmentation import SegmenterInput, SegmenterOutput, MaskFormat
+from ..utils.cache import LRUCache, tensor_nbytes
+from ..utils.common import load_image, full_size, content_hash
+from ..utils.masks import encode_png, encode_rle, pack_masks
+from ..utils.memory import pinned
+from ..utils.metrics import stage_timer
+from .replicas import ReplicaPool
+from .residency import module_nbytes
+from .worker import InferenceWorker, WorkItem
 
 
-class Sam2Segmenter:
-    def __init__(self):
+@dataclass
+class _BatchItem:
+    work_item: WorkItem
+    key: str
+    # Preprocessed image and its original size, on the first item of each image missing from the embedding cache
+    pixel_values: Optional[torch.Tensor] = None
+    original_size: Optional[List[int]] = None
+    # (per-level image embeddings, original size) or the error raised while embedding
+    embedding: Optional[Union[tuple, Exception]] = None
+
+    @property
+    def input_data(self) -> SegmenterInput:
+        return self.work_item.input_data
+
+
+class Sam2Segmenter(InferenceWorker):
+    task_type = "segment"
+    model_name = "sam2"
+
+    def __init__(self, device: Optional[str] = None, replica: Optional[int] = None, slot: int = 0):
+        super().__init__(device, replica, slot)
         self.model_id = config.sam2_model_id
-        self.device = config.device
-        self.model = Sam2Model.from_pretrained(self.model_id, cache_dir=config.hf_home).to(self.device)
+        self.model: Optional[Sam2Model] = None
+        self.processor: Optional[Sam2Processor] = None
+        # Side of the square the processor resizes to; larger JPEGs are decoded at reduced size
+        self.decode_min_size: Optional[int] = None
+
+        self.max_batch_size = max(1, config.sam2_max_batch_size)
+        self.max_batch_wait = config.sam2_max_batch_wait_ms / 1000
+        self.max_queue_size = config.sam2_max_queue_size
+        self.max_queue_wait = config.sam2_max_queue_wait_s
+        self.preprocess_workers = config.sam2_preprocess_workers
+        self.postprocess_workers = config.sam2_postprocess_workers
+        self.embedding_cache = LRUCache(
+            max_items=config.sam2_embedding_cache_size,
+            max_bytes=config.sam2_embedding_cache_mb * 1024 * 1024
+        )
+
+        self._start_worker()
+
+    def _load_model(self):
+        self.model = Sam2Model.from_pretrained(self.model_id, cache_dir=config.hf_home)
         self.processor = Sam2Processor.from_pretrained(self.model_id, cache_dir=config.hf_home)
+        size = self.processor.image_processor.size
+        self.decode_min_size = max(size.get("height", 0), size.get("width", 0)) or None
         self.model.eval()
 
-        self._queue = queue.Queue()
-        self._stop_event = threading.Event()
+    def _move_model(self, device: str):
+        if device != self.device:
+            # Cached embeddings live on the device and would pin memory the offload is meant to free
+            self.embedding_cache.clear()
+        self.model.to(device)
+
+    def _model_nbytes(self) -> int:
+        return module_nbytes(self.model)
+
+    @staticmethod
+    def _image_key(input_data: SegmenterInput) -> str:
+        if input_data.image_key:
+            return input_data.image_key
+        if isinstance(input_data.image, Image.Image):
+            return content_hash(input_data.image.tobytes())
+        return content_hash(input_data.image)
+
+    @staticmethod
+    def _prompt_signature(input_data: SegmenterInput) -> tuple:
+        # The processor pads points within an object, but padding objects or boxes
+        # would add spurious masks, so only requests with the same object counts batch together.
+        return len(input_data.points or []), len(input_data.boxes or [])
 
-        self._worker_thread = threading.Thread(target=self._inference_worker, daemon=True)
-        self._worker_thread.start()
+    def _run_isolated(self, fn: Callable[[list], list], items: list) -> list:
+        try:
+            return self.memory_manager.run(fn, items)
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
 
-    def _inference_worker(self):
-        while not self._stop_event.is_set():
+        # Retry one by one so a single bad request does not fail the whole batch
+        results = []
+        for item in items:
             try:
-                input_data, result_queue = self._queue.get(timeout=0.1)
-            except queue.Empty:
+                results.extend(self.memory_manager.run(fn, [item]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _preprocess_batch(self, batch: List[WorkItem]) -> List[_BatchItem]:
+        items, prepared = [], set()
+        for work_item in batch:
+            item = _BatchItem(work_item, self._image_key(work_item.input_data))
+            # Misses are counted on the device, where a batch ahead of this one may still fill them
+            if item.key in self.embedding_cache:
+                item.embedding = self.embedding_cache.get(item.key)
+            if item.embedding is None and item.key not in prepared:
+                try:
+                    item.pixel_values, item.original_size = self._prepare_image(work_item.input_data.image)
+                except Exception as e:
+                    work_item.set_result("error", str(e))
+                    continue
+                prepared.add(item.key)
+            items.append(item)
+        return items
+
+    def _prepare_image(self, image: Union[bytes, Image.Image]) -> tuple:
+        with stage_timer(self.model_name, "decode"):
+            image = load_image(image, self.decode_min_size)
+        with stage_timer(self.model_name, "preprocess"):
+            pixel_values = self.processor(images=[image], return_tensors="pt")["pixel_values"]
+        # Prompts and masks are relative to the upload, which may be larger than a reduced-size decode
+        return pinned(pixel_values, self.device), list(full_size(image)[::-1])
+
+    def _forward_batch(self, batch: List[WorkItem], items: List[_BatchItem]) -> List[tuple]:
+        missing = {}
+        for item in items:
+            if item.embedding is None:
+                missing.setdefault(item.key, []).append(item)
+
+        for key in list(missing):
+            embedding = self.embedding_cache.get(key)
+            if embedding is not None:
+                for item in missing.pop(key):
+                    item.embedding = embedding
+
+        if missing:
+            keys = list(missing)
+            embeddings = self._run_isolated(
+                lambda batch_keys: self._embed([missing[key][0] for key in batch_keys]),
+                keys
+            )
+            for key, embedding in zip(keys, embeddings):
+                if not isinstance(embedding, Exception):
+                    self.embedding_cache.put(key, embedding, tensor_nbytes(*embedding[0]))
+                for item in missing[key]:
+                    item.embedding = embedding
+
+        outputs = []
+        groups = {}
+        for item in items:
+            if isinstance(item.embedding, Exception):
+                outputs.append((item, item.embedding))
                 continue
+            groups.setdefault(self._prompt_signature(item.input_data), []).append(item)
+
+        for group in groups.values():
+            outputs.extend(zip(group, self._run_isolated(self._predict, group)))
+        return outputs
 
+    def _postprocess_batch(self, batch: List[WorkItem], outputs: List[tuple]):
+        for item, output in outputs:
+            if isinstance(output, Exception):
+                item.work_item.set_result("error", str(output))
+                continue
             try:
-                result = self._process(input_data)
-                result_queue.put(("success", result))
+                item.work_item.set_result("success", self._postprocess_masks(item.input_data, *output))
             except Exception as e:
-                result_queue.put(("error", str(e)))
-            finally:
-                self._queue.task_done()
+                item.work_item.set_result("error", str(e))
+
+    def _embed(self, items: List[_BatchItem]) -> List[tuple]:
+        # torch.cat on the host would land in pageable memory and make the copy synchronous; each
+        # item's pinned tensor is copied straight into its slice of the device batch instead
+        first = items[0].pixel_values
+        pixel_values = torch.empty((len(items), *first.shape[1:]), dtype=first.dtype, device=self.device)
+        for i, item in enumerate(items):
+            pixel_values[i:i + 1].copy_(item.pixel_values, non_blocking=True)
+
+        with torch.no_grad(), stage_timer(self.model_name, "forward", self.device):
+            image_embeddings = self.model.get_image_embeddings(pixel_values)
+
+        return [
+            ([level[i:i + 1].clone() for level in image_embeddings], item.original_size)
+            for i, item in enumerate(items)
+        ]
 
-    def _process(self, input_data: SegmenterInput) -> SegmenterOutput:
-        image = load_image(input_data.image)
+    def _predict(self, items: List[_BatchItem]) -> List[tuple]:
+        """Low-resolution masks and scores per item, on the CPU, ready for `_postprocess_masks`."""
+        inputs = [item.input_data for item in items]
 
-        kwargs = {"images": image, "return_tensors": "pt"}
-        if input_data.points and input_data.labels:
-            kwargs["input_points"] = [[input_data.points]]
-            kwargs["input_labels"] = [[input_data.labels]]
-        if input_data.boxes:
-            kwargs["input_boxes"] = [[input_data.boxes]]
+        kwargs = {"original_sizes": [item.embedding[1] for item in items], "return_tensors": "pt"}
+        if inputs[0].points and inputs[0].labels:
+            kwargs["input_points"] = [input_data.points for input_data in inputs]
+            kwargs["input_labels"] = [input_data.labels for input_data in inputs]
+        if inputs[0].boxes:
+            kwargs["input_boxes"] = [input_data.boxes for input_data in inputs]
 
-        inputs = self.processor(**kwargs).to(self.device)
+        with stage_timer(self.model_name, "preprocess"):
+            prompt_inputs = self.processor(**kwargs).to(self.device)
+        prompt_inputs.pop("original_sizes")
 
-        with torch.no_grad():
-            outputs = self.model(**inputs, multimask_output=False)
+        # Only the prompt encoder and mask decoder run here, once for all objects of every image;
+        # image embeddings come from the cache or _embed
+        image_embeddings = [
+            torch.cat([item.embedding[0][level] for item in items])
+            for level in range(len(items[0].embedding[0]))
+        ]
 
-        masks = self.processor.post_process_masks(
-            outputs.pred_masks.cpu(),
-            inputs["original_sizes"]
-        )[0]
+        with torch.no_grad(), stage_timer(self.model_name, "forward", self.device):
+            outputs = self.model(**prompt_inputs, image_embeddings=image_embeddings, multimask_output=False)
+            pred_masks = outputs.pred_masks.cpu()
+            iou_scores = outputs.iou_scores.cpu()
 
-        scores = outputs.iou_scores.squeeze().cpu().tolist()
+        return [
+            (pred_masks[i:i + 1], iou_scores[i], item.embedding[1])
+            for i, item in enumerate(items)
+        ]
+
+    def _postprocess_masks(
+            self,
+            input_data: SegmenterInput,
+            pred_masks: torch.Tensor,
+            scores: torch.Tensor,
+            original_size: List[int]
+    ) -> SegmenterOutput:
+        with stage_timer(self.model_name, "postprocess"):
+            masks = self.processor.post_process_masks(pred_masks, [original_size])[0]
+
+        scores = scores.squeeze().tolist()
         if isinstance(scores, float):
             scores = [scores]
 
-        mask_bytes = []
-        for mask in masks:
-            mask_array = mask.numpy().squeeze()
-            pil_mask = Image.fromarray((mask_array * 255).astype("uint8"))
-            buffer = io.BytesIO()
-            pil_mask.save(buffer, format="PNG")
-            mask_bytes.append(buffer.getvalue())
-
-        if config.cuda_frequent_empty_cache:
-            gc.collect()
-            torch.cuda.empty_cache()
-
-        return SegmenterOutput(
-            masks=mask_bytes,
-            scores=scores,
-            shape=tuple(masks.shape)
-        )
+        with stage_timer(self.model_name, "encode"):
+            return self._encode_masks(input_data.output_format, masks, scores)
+
+    @staticmethod
+    def _encode_masks(output_format: MaskFormat, masks: torch.Tensor, scores: List[float]) -> SegmenterOutput:
+        shape = tuple(masks.shape)
+        mask_arrays = masks.numpy().reshape(shape[0], *shape[-2:])
 
-    def segment(self, input_data: SegmenterInput) -> SegmenterOutput:
-        result_queue = queue.Queue()
-        self._queue.put((input_data, result_queue))
+        if output_format == MaskFormat.RLE:
+            return SegmenterOutput(rle=[encode_rle(mask) for mask in mask_arrays], scores=scores, shape=shape)
+        if output_format == MaskFormat.PACKBITS:
+            return SegmenterOutput(packed=pack_masks(masks.numpy()), scores=scores, shape=shape)
+        return SegmenterOutput(masks=[encode_png(mask) for mask in mask_arrays], scores=scores, shape=shape)
 
-        status, result = result_queue.get()
+    async def segment(self, input_data: SegmenterInput) -> SegmenterOutput:
+        status, result = await self._submit(input_data)
         if status == "error":
             raise RuntimeError(f"Inference failed: {result}")
 
         return result
 
     def stop(self):
-        self._stop_event.set()
-        self._worker_thread.join()
+        super().stop()
+        self.embedding_cache.clear()
         del self.model, self.processor
         torch.cuda.empty_cache()
+
+
+class Sam2SegmenterPool(ReplicaPool[Sam2Segmenter]):
+    def __init__(self):
+        super().__init__(Sam2Segmenter, config.sam2_devices)
+        # Replica each recent image was sent to, so requests for an image still being embedded follow it there
+        self._routes: OrderedDict = OrderedDict()
+        self._max_routes = max(1, config.sam2_embedding_cache_size) * len(self.replicas)
+
+    async def segment(self, input_data: SegmenterInput) -> SegmenterOutput:
+        if len(self.replicas) > 1 and not input_data.image_key:
+            # Hashed here rather than on the worker, so the request can follow its cached embedding
+            input_data.image_key = await asyncio.to_thread(Sam2Segmenter._image_key, input_data)
+        key = input_data.image_key
+        replica = self.pick(prefer=lambda r: self._routes.get(key) is r or key in r.embedding_cache)
+        if len(self.replicas) > 1:
+            self._routes[key] = replica
+            self._routes.move_to_end(key)
+            if len(self._routes) > self._max_routes:
+                self._routes.popitem(last=False)
+        return await replica.segment(input_data)
@@ -0,0 +1,480 @@
+import asyncio
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Optional
+
+from ..configs import config
+from ..utils.memory import memory_manager_for, normalize_device
+from ..utils.metrics import STAGE_SECONDS, BATCH_SIZE, IN_FLIGHT, QUEUE_DEPTH
+from .residency import residency_manager
+from .scheduler import scheduler_for
+
+
+@dataclass(eq=False)
+class WorkItem:
+    input_data: Any
+    future: asyncio.Future
+    task_type: Optional[str] = None
+    # Only set for streaming submissions; receives (event, data) tuples emitted by the worker
+    events: Optional[asyncio.Queue] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.future.cancelled()
+
+    def emit(self, event: str, data: dict):
+        if self.events is not None:
+            self.future.get_loop().call_soon_threadsafe(self.events.put_nowait, (event, data))
+
+    def set_result(self, status: str, result: Any):
+        # Called from the worker thread; the future belongs to the event loop that submitted the item
+        self.future.get_loop().call_soon_threadsafe(self._resolve, status, result)
+
+    def _resolve(self, status: str, result: Any):
+        # The caller may have gone away (client disconnect cancels the awaiting task)
+        if not self.future.done():
+            self.future.set_result((status, result))
+        if self.events is not None:
+            self.events.put_nowait(("done", None))
+
+
+class _EventStream:
+    """
+    The iterator `_submit_stream` returns. The item stays counted as outstanding until the stream
+    finishes, fails, is closed, or is dropped without ever being iterated (a response whose
+    headers could not be sent, say); the last two also cancel the item so the worker skips it.
+    """
+
+    def __init__(self, worker: "InferenceWorker", item: WorkItem, events: AsyncIterator[tuple]):
+        self._worker = worker
+        self._item = item
+        self._events = events
+        self._released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> tuple:
+        try:
+            return await self._events.__anext__()
+        except BaseException:
+            # Exhausted, failed, or cancelled because the client went away
+            self._release()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._events.aclose()
+        finally:
+            self._release()
+
+    def _release(self, threadsafe: bool = False):
+        if self._released:
+            return
+        self._released = True
+        self._worker._add_outstanding(-1)
+        if threadsafe:
+            try:
+                self._item.future.get_loop().call_soon_threadsafe(self._cancel_item)
+            except RuntimeError:
+                # Event loop already closed; nothing is waiting for the item anymore
+                pass
+        else:
+            self._cancel_item()
+
+    def _cancel_item(self):
+        if not self._item.future.done():
+            self._item.future.cancel()
+
+    def __del__(self):
+        # May run on any thread, whenever the last reference goes
+        self._release(threadsafe=True)
+
+
+class QueueFullError(Exception):
+    """Raised instead of queueing a request the worker cannot serve in time."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        # Whole seconds, as sent in the Retry-After header
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class InferenceWorker:
+    """
+    Base class for model wrappers that run inference on a dedicated thread.
+
+    Entry points await `_submit`, which queues a `WorkItem` and returns the worker's
+    `(status, result)` tuple without holding a thread while the request waits.
+    The worker thread only collects batches; they execute on the GPU scheduler of the
+    worker's device under the item's `task_type`, or the worker's own when the item has none.
+    Each worker is one replica of its model on one device; see `ReplicaPool` for several.
+
+    Subclasses build their model in `_load_model` and move it in `_move_model`; the
+    residency manager calls both, so models can load lazily and leave the device when idle.
+
+    A batch passes through three stages: `_preprocess_batch` and `_postprocess_batch` on the
+    CPU, and `_forward_batch` on the GPU scheduler. With `preprocess_workers` or
+    `postprocess_workers` set, those stages run on their own thread pools, so the next batches
+    are decoded and the previous ones post-processed while the device works on the current one.
+    """
+
+    task_type: Optional[str] = None
+    # "model" label of the worker's metrics
+    model_name = "model"
+    # Weight of the newest observation in the moving average of per-item service time
+    service_time_smoothing = 0.2
+    # Seconds of recent history that `utilization` covers
+    utilization_window = 60.0
+
+    def __init__(self, device: Optional[str] = None, replica: Optional[int] = None, slot: int = 0):
+        # Normalized, so residency budgets, schedulers and memory managers agree on which device this is
+        self.device = normalize_device(device or config.device)
+        # Residency and gauge key; histograms keep the model name, so replicas add up there
+        self.replica_name = self.model_name if replica is None else f"{self.model_name}:{replica}"
+        self.scheduler = scheduler_for(self.device, slot)
+        self.memory_manager = memory_manager_for(self.device)
+
+        self.max_batch_size = 1
+        self.max_batch_wait = 0.0
+        # Admission limits, 0 disables: queued item count and estimated seconds until a new item starts
+        self.max_queue_size = 0
+        self.max_queue_wait = 0.0
+
+        # Threads per CPU stage; 0 runs the stage on the worker thread
+        self.preprocess_workers = 0
+        self.postprocess_workers = 0
+
+        self.service_time: Optional[float] = None
+        self._in_flight = 0
+        # Submitted items without a result yet, wherever they are; the replica pool balances on it
+        self._outstanding = 0
+        self._stats_lock = threading.Lock()
+        self._created_at = time.monotonic()
+        # (finished_at, seconds) of recent forward stages, and when the running one started
+        self._busy = deque()
+        self._busy_since: Optional[float] = None
+
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._worker_thread = threading.Thread(target=self._inference_worker, daemon=True)
+        self._forward_thread: Optional[threading.Thread] = None
+        # Preprocessed batches waiting for the device, oldest first
+        self._ready: Optional[queue.Queue] = None
+        self._preprocess_pool: Optional[ThreadPoolExecutor] = None
+        self._postprocess_pool: Optional[ThreadPoolExecutor] = None
+
+    def _start_worker(self):
+        residency_manager.register(self)
+        if self.preprocess_workers > 0:
+            self._preprocess_pool = ThreadPoolExecutor(self.preprocess_workers, thread_name_prefix=f"{self.replica_name}-preprocess")
+            # Preprocessing runs at most this many batches ahead of the device
+            self._ready = queue.Queue(maxsize=self.preprocess_workers)
+            self._forward_thread = threading.Thread(target=self._forward_worker, daemon=True)
+        if self.postprocess_workers > 0:
+            self._postprocess_pool = ThreadPoolExecutor(self.postprocess_workers, thread_name_prefix=f"{self.replica_name}-postprocess")
+        self._worker_thread.start()
+        if self._forward_thread is not None:
+            # Started second: it exits once the collecting thread is gone and nothing is left to run
+            self._forward_thread.start()
+
+    def _load_model(self):
+        """Builds the model in CPU memory."""
+        raise NotImplementedError
+
+    def _move_model(self, device: str):
+        raise NotImplementedError
+
+    def _model_nbytes(self) -> int:
+        raise NotImplementedError
+
+    def _inference_worker(self):
+        while not self._stop_event.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            try:
+                self._collect_batch(batch)
+                pending = [item for item in batch if not item.cancelled]
+                if pending and self._ensure_loaded(pending):
+                    self._add_in_flight(len(pending))
+                    QUEUE_DEPTH.set(self._queue.qsize(), model=self.replica_name)
+                    if self._preprocess_pool is None:
+                        self._run_stages(pending, self._preprocess(pending))
+                    else:
+                        # Blocks while the device is that far behind, which leaves new requests queued
+                        self._ready.put((pending, self._preprocess_pool.submit(self._preprocess, pending)))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _forward_worker(self):
+        # Runs until the collecting thread has stopped and every batch it handed over is answered
+        while self._worker_thread.is_alive() or not self._ready.empty():
+            try:
+                batch, prepared = self._ready.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self._run_stages(batch, prepared)
+
+    def _add_in_flight(self, count: int):
+        with self._stats_lock:
+            self._in_flight += count
+            IN_FLIGHT.set(self._in_flight, model=self.replica_name)
+
+    def _preprocess(self, batch: list) -> Any:
+        try:
+            return self._preprocess_batch(batch)
+        except Exception as e:
+            for item in batch:
+                item.set_result("error", str(e))
+            return None
+
+    def _run_stages(self, batch: list, prepared: Any):
+        try:
+            if isinstance(prepared, Future):
+                prepared = prepared.result()
+            if prepared is None:
+                return
+
+            started = time.monotonic()
+            outputs = self.scheduler.run(batch[0].task_type or self.task_type, self._run_batch, batch, prepared)
+            self._record_service_time((time.monotonic() - started) / len(batch))
+        finally:
+            self._add_in_flight(-len(batch))
+
+        if outputs is None:
+            return
+        if self._postprocess_pool is None:
+            self._postprocess(batch, outputs)
+        else:
+            self._postprocess_pool.submit(self._postprocess, batch, outputs)
+
+    def _postprocess(self, batch: list, outputs: Any):
+        try:
+            self._postprocess_batch(batch, outputs)
+        except Exception as e:
+            for item in batch:
+                item.set_result("error", str(e))
+
+    def _ensure_loaded(self, batch: list) -> bool:
+        # Loading runs here rather than on the GPU scheduler, which other models keep using meanwhile
+        try:
+            residency_manager.load(self.replica_name)
+            return True
+        except Exception as e:
+            for item in batch:
+                item.set_result("error", f"Model failed to load: {e}")
+            return False
+
+    def _run_batch(self, batch: list, prepared: Any) -> Any:
+        # Queue wait runs until the GPU scheduler actually starts the batch
+        now = time.monotonic()
+        for item in batch:
+            STAGE_SECONDS.observe(now - item.enqueued_at, model=self.model_name, stage="queue_wait")
+        BATCH_SIZE.observe(len(batch), model=self.model_name)
+        with self._stats_lock:
+            self._busy_since = now
+        try:
+            with residency_manager.use(self.replica_name):
+                return self._forward_batch(batch, prepared)
+        except Exception as e:
+            # `_forward_batch` reports its own errors, so this is the move to the device failing
+            for item in batch:
+                item.set_result("error", f"Model could not be moved to {self.device}: {e}")
+            return None
+        finally:
+            finished = time.monotonic()
+            with self._stats_lock:
+                self._busy.append((finished, finished - now))
+                self._busy_since = None
+            self.memory_manager.maybe_trim()
+
+    def _record_service_time(self, seconds: float):
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            self.service_time += self.service_time_smoothing * (seconds - self.service_time)
+
+    def utilization(self) -> float:
+        """Fraction of the last `utilization_window` seconds this replica spent in forward passes."""
+        now = time.monotonic()
+        start = now - self.utilization_window
+        with self._stats_lock:
+            while self._busy and self._busy[0][0] <= start:
+                self._busy.popleft()
+            busy = sum(min(seconds, finished - start) for finished, seconds in self._busy)
+            if self._busy_since is not None:
+                busy += now - max(self._busy_since, start)
+        return min(1.0, busy / max(now - max(start, self._created_at), 1e-6))
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def outstanding(self) -> int:
+        return self._outstanding
+
+    def _add_outstanding(self, count: int):
+        # Only called from the event loop, like the submissions it counts
+        self._outstanding += count
+
+    def estimated_wait(self, extra_items: int = 0) -> float:
+        """Seconds until the queue, plus `extra_items` more, has drained, from the average per-item service time."""
+        if self.service_time is None:
+            return 0.0
+        return (self._queue.qsize() + self._in_flight + extra_items) * self.service_time
+
+    def _admit(self, num_items: int = 1):
+        depth = self._queue.qsize()
+        if self.max_queue_size and depth + num_items > self.max_queue_size:
+            raise QueueFullError(
+                f"Queue is full ({depth} waiting, limit {self.max_queue_size})",
+                retry_after=self.service_time or 1
+            )
+
+        wait = self.estimated_wait(num_items - 1)
+        if self.max_queue_wait and wait > self.max_queue_wait:
+            raise QueueFullError(
+                f"Estimated wait of {wait:.1f}s exceeds the {self.max_queue_wait:g}s limit",
+                retry_after=wait - self.max_queue_wait
+            )
+
+    def queue_stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize(),
+            "in_flight": self._in_flight,
+            "max_size": self.max_queue_size,
+            "max_wait": self.max_queue_wait,
+            "service_time": self.service_time,
+            "estimated_wait": self.estimated_wait(),
+            "utilization": self.utilization(),
+        }
+
+    def _collect_batch(self, batch: list):
+        # Drain whatever is already queued, then wait up to max_batch_wait for stragglers
+        deadline = time.monotonic() + self.max_batch_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+    def _preprocess_batch(self, batch: list) -> Any:
+        """
+        CPU work ahead of the forward pass. Returns what `_forward_batch` needs, or None to drop
+        the batch; items whose input is unusable get their error here and are dropped alone.
+        """
+        return batch
+
+    def _forward_batch(self, batch: list, prepared: Any) -> Any:
+        """
+        Runs on the GPU scheduler with the model on the device. Returns what `_postprocess_batch`
+        needs, or None once every item has its result.
+        """
+        self._process_batch(batch)
+        return None
+
+    def _postprocess_batch(self, batch: list, outputs: Any):
+        """CPU work after the forward pass; sets each item's result."""
+        raise NotImplementedError
+
+    def _process_batch(self, batch: list):
+        for item in batch:
+            try:
+                result = self.memory_manager.run(self._process_item, item)
+                item.set_result("success", result)
+            except Exception as e:
+                item.set_result("error", str(e))
+
+    def _process_item(self, item: WorkItem) -> Any:
+        return self._process(item.input_data)
+
+    def _process(self, input_data: Any) -> Any:
+        raise NotImplementedError
+
+    async def _submit(self, input_data: Any, task_type: Optional[str] = None, admit: bool = True) -> tuple:
+        if admit:
+            self._admit()
+        loop = asyncio.get_running_loop()
+        item = WorkItem(input_data=input_data, future=loop.create_future(), task_type=task_type)
+        self._queue.put(item)
+        QUEUE_DEPTH.set(self._queue.qsize(), model=self.replica_name)
+        self._add_outstanding(1)
+        try:
+            return await item.future
+        finally:
+            self._add_outstanding(-1)
+
+    def queue_position(self, item: WorkItem) -> Optional[int]:
+        """Number of items ahead of `item`, or None once the worker has picked it up."""
+        with self._queue.mutex:
+            for position, queued in enumerate(self._queue.queue):
+                if queued is item:
+                    return position
+        return None
+
+    def _submit_stream(self, input_data: Any, task_type: Optional[str] = None) -> AsyncIterator[tuple]:
+        """
+        Like `_submit`, but returns an iterator of `(event, data)` tuples for while the request
+        waits and runs: `queued` whenever the queue position changes, whatever the worker emits,
+        and finally `result` carrying the `(status, result)` tuple.
+
+        Admission happens here, before any event is produced, so callers can still reject
+        the request with a plain error response. Must be called from the event loop. Closing
+        or dropping the returned stream before the result cancels the item (see `_EventStream`).
+        """
+        self._admit()
+        loop = asyncio.get_running_loop()
+        item = WorkItem(input_data=input_data, future=loop.create_future(), task_type=task_type, events=asyncio.Queue())
+        self._queue.put(item)
+        QUEUE_DEPTH.set(self._queue.qsize(), model=self.replica_name)
+        self._add_outstanding(1)
+        return _EventStream(self, item, self._stream_events(item))
+
+    async def _stream_events(self, item: WorkItem) -> AsyncIterator[tuple]:
+        last_position = None
+        while True:
+            position = self.queue_position(item)
+            if position is not None and position != last_position:
+                last_position = position
+                yield "queued", {"position": position}
+
+            try:
+                event, data = await asyncio.wait_for(item.events.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+
+            if event == "done":
+                break
+            yield event, data
+
+        yield "result", item.future.result()
+
+    def stop(self):
+        self._stop_event.set()
+        self._worker_thread.join()
+        if self._forward_thread is not None:
+            self._forward_thread.join()
+        for pool in (self._preprocess_pool, self._postprocess_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        residency_manager.unregister(self.replica_name)
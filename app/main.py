@@ -1,14 +1,30 @@
 import os
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
-from .routers import segmentation_router, object_detection_router, generation_router
+from .internal.residency import residency_manager
+from .internal.scheduler import scheduler_stats
+from .routers import segmentation_router, object_detection_router, generation_router, pipeline_router, jobs_router
+from .utils.metrics import registry
 
 app = FastAPI(root_path=os.getenv("IMAGE_ROOT_PATH") or "")
 app.include_router(segmentation_router, prefix="/segment", tags=["segmentation"])
 app.include_router(object_detection_router, prefix="/detect", tags=["object_detection"])
 app.include_router(generation_router, prefix="/generate", tags=["image_generation"])
+app.include_router(pipeline_router, prefix="/pipeline", tags=["pipeline"])
+app.include_router(jobs_router, prefix="/jobs", tags=["jobs"])
 
 @app.get("/health")
-async def health_check():
-    return {"status": "ok"}
+def health_check():
+    # Sync, so FastAPI runs it in the threadpool: the stats briefly take locks the model threads also use
+    return {
+        "status": "ok" if residency_manager.ready else "loading",
+        "gpu_schedulers": scheduler_stats(),
+        "models": residency_manager.stats()
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -9,6 +9,23 @@ class TaskType(str, Enum):
     INPAINT = "inpaint"
 
 
+class ImageFormat(str, Enum):
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpeg"
+    # Uncompressed uint8 HxWx3 array in .npy format
+    RAW = "raw"
+
+
+# Media type and file extension per output format
+IMAGE_FORMAT_FILES = {
+    ImageFormat.PNG: ("image/png", "png"),
+    ImageFormat.WEBP: ("image/webp", "webp"),
+    ImageFormat.JPEG: ("image/jpeg", "jpg"),
+    ImageFormat.RAW: ("application/x-npy", "npy"),
+}
+
+
 class GenerateInput(BaseModel):
     prompt: str
     negative_prompt: str = ""
@@ -17,6 +34,11 @@ class GenerateInput(BaseModel):
     num_inference_steps: int = 50
     true_cfg_scale: float = 4.0
     seed: Optional[int] = None
+    num_images: int = 1
+    cache_threshold: Optional[float] = None
+    output_format: ImageFormat = ImageFormat.PNG
+    quality: int = 90
+    compress_level: int = 6
 
 
 class InpaintInput(BaseModel):
@@ -28,10 +50,31 @@ class InpaintInput(BaseModel):
     true_cfg_scale: float = 4.0
     controlnet_conditioning_scale: float = 1.0
     seed: Optional[int] = None
+    crop_to_mask: bool = False
+    crop_padding: int = 64
+    crop_resolution: int = 1024
+    feather: int = 16
+    output_format: ImageFormat = ImageFormat.PNG
+    quality: int = 90
+    compress_level: int = 6
 
 
 class GeneratorOutput(BaseModel):
-    image: bytes
+    images: List[bytes]
+    output_format: ImageFormat = ImageFormat.PNG
+    cache_skip_ratio: Optional[float] = None
+
+    @property
+    def image(self) -> bytes:
+        return self.images[0]
+
+    @property
+    def media_type(self) -> str:
+        return IMAGE_FORMAT_FILES[self.output_format][0]
+
+    @property
+    def extension(self) -> str:
+        return IMAGE_FORMAT_FILES[self.output_format][1]
 
 
 class GenerateRequest(BaseModel):
@@ -42,6 +85,17 @@ class GenerateRequest(BaseModel):
     num_inference_steps: int = Field(50, description="Number of denoising steps", ge=1, le=100)
     true_cfg_scale: float = Field(4.0, description="Classifier-free guidance scale", ge=1.0, le=20.0)
     seed: Optional[int] = Field(None, description="Random seed for reproducibility")
+    num_images: int = Field(1, description="Number of images to generate; with a seed, image i uses seed + i", ge=1, le=8)
+    cache_threshold: Optional[float] = Field(
+        None,
+        description="Enables first-block caching: transformer steps whose first-block output changed by less than this "
+                    "relative amount reuse the previous step's result. Around 0.05-0.1 is a mild speedup; unset disables it",
+        ge=0.0,
+        le=1.0
+    )
+    output_format: ImageFormat = Field(ImageFormat.PNG, description="png, webp, jpeg, or raw for an uncompressed .npy array")
+    quality: int = Field(90, description="WebP/JPEG quality", ge=1, le=100)
+    compress_level: int = Field(6, description="PNG zlib level; lower encodes faster into larger files", ge=0, le=9)
 
 
 class InpaintRequest(BaseModel):
@@ -51,3 +105,10 @@ class InpaintRequest(BaseModel):
     true_cfg_scale: float = Field(4.0, description="Classifier-free guidance scale", ge=1.0, le=20.0)
     controlnet_conditioning_scale: float = Field(1.0, description="ControlNet conditioning scale", ge=0.0, le=2.0)
     seed: Optional[int] = Field(None, description="Random seed for reproducibility")
+    crop_to_mask: bool = Field(False, description="Inpaint only the mask's bounding box and blend it back into the image")
+    crop_padding: int = Field(64, description="Context pixels kept around the mask's bounding box", ge=0, le=1024)
+    crop_resolution: int = Field(1024, description="Side of the square area the crop is resized to for inpainting", ge=512, le=2048)
+    feather: int = Field(16, description="Width in pixels of the blended seam around the mask", ge=0, le=256)
+    output_format: ImageFormat = Field(ImageFormat.PNG, description="png, webp, jpeg, or raw for an uncompressed .npy array")
+    quality: int = Field(90, description="WebP/JPEG quality", ge=1, le=100)
+    compress_level: int = Field(6, description="PNG zlib level; lower encodes faster into larger files", ge=0, le=9)
@@ -0,0 +1,30 @@
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from .generation import TaskType
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class JobRecord(BaseModel):
+    """State of an asynchronous generation job, persisted as job.json next to its result."""
+    id: str
+    task_type: TaskType
+    status: JobStatus = JobStatus.QUEUED
+    created_at: float
+    updated_at: float
+    queue_position: Optional[int] = Field(None, description="Requests ahead of this one while queued")
+    progress: Optional[dict] = Field(None, description="Latest step, total_steps, elapsed and eta while running")
+    error: Optional[str] = None
+    media_type: Optional[str] = Field(None, description="Media type of the requested output format, or application/zip for several images")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.SUCCEEDED, JobStatus.FAILED)
@@ -1,10 +1,21 @@
-from typing import List
+from typing import List, Union
 
-from pydantic import BaseModel, Field
+from PIL import Image
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class DetectorInput(BaseModel):
-    image: bytes
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    image: Union[bytes, Image.Image]
+    text: List[str]
+    threshold: float = 0.2
+
+
+class DetectorBatchInput(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    images: List[Union[bytes, Image.Image]]
     text: List[str]
     threshold: float = 0.2
 
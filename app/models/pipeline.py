@@ -0,0 +1,15 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from .segmentation import MaskFormat
+
+
+class GroundedSegmentRequest(BaseModel):
+    """Request schema for text-prompted detection followed by box-prompted segmentation."""
+    text: List[str] = Field(..., description="List of text prompts (e.g., ['a cat', 'a dog'])")
+    threshold: float = Field(0.2, description="Detection confidence threshold", ge=0.0, le=1.0)
+    output_format: MaskFormat = Field(
+        MaskFormat.ZIP,
+        description="Mask encoding: 'zip' (PNG per mask), 'rle' (COCO RLE as JSON) or 'packbits' (bit-packed buffer after a length-prefixed JSON preamble)"
+    )
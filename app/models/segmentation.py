@@ -1,18 +1,35 @@
-from typing import List, Optional
+from enum import Enum
+from typing import List, Optional, Union, Dict, Any
 from typing import Tuple
 
-from pydantic import BaseModel, Field
+from PIL import Image
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class MaskFormat(str, Enum):
+    ZIP = "zip"
+    RLE = "rle"
+    PACKBITS = "packbits"
 
 
 class SegmenterInput(BaseModel):
-    image: bytes
-    points: Optional[List[List[int]]] = None
-    labels: Optional[List[int]] = None
-    boxes: Optional[List[int]] = None
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    image: Union[bytes, Image.Image]
+    # Content hash of the original upload, used as the embedding cache key for decoded images
+    image_key: Optional[str] = None
+    # One entry per object to segment: a point group with its labels and/or a box
+    points: Optional[List[List[List[int]]]] = None
+    labels: Optional[List[List[int]]] = None
+    boxes: Optional[List[List[int]]] = None
+    output_format: MaskFormat = MaskFormat.ZIP
 
 
 class SegmenterOutput(BaseModel):
-    masks: List[bytes]
+    # Exactly one of masks (PNG per mask), rle (COCO RLE per mask) or packed (all masks bit-packed) is set
+    masks: List[bytes] = []
+    rle: List[Dict[str, Any]] = []
+    packed: Optional[bytes] = None
     scores: List[float]
     shape: Tuple
 
@@ -29,6 +46,10 @@ class PointSegmentRequest(BaseModel):
         description="Labels for each point (1=positive click, 0=negative click)",
         examples=[[1, 1]]
     )
+    output_format: MaskFormat = Field(
+        MaskFormat.ZIP,
+        description="Mask encoding: 'zip' (PNG per mask), 'rle' (COCO RLE as JSON) or 'packbits' (bit-packed buffer after a length-prefixed JSON preamble)"
+    )
 
 
 class BoxSegmentRequest(BaseModel):
@@ -40,6 +61,10 @@ class BoxSegmentRequest(BaseModel):
         min_length=4,
         max_length=4
     )
+    output_format: MaskFormat = Field(
+        MaskFormat.ZIP,
+        description="Mask encoding: 'zip' (PNG per mask), 'rle' (COCO RLE as JSON) or 'packbits' (bit-packed buffer after a length-prefixed JSON preamble)"
+    )
 
 
 class CombinedSegmentRequest(BaseModel):
@@ -61,3 +86,30 @@ class CombinedSegmentRequest(BaseModel):
         min_length=4,
         max_length=4
     )
+    output_format: MaskFormat = Field(
+        MaskFormat.ZIP,
+        description="Mask encoding: 'zip' (PNG per mask), 'rle' (COCO RLE as JSON) or 'packbits' (bit-packed buffer after a length-prefixed JSON preamble)"
+    )
+
+
+class MultiSegmentRequest(BaseModel):
+    """Request schema for segmenting multiple objects in one image."""
+    boxes: Optional[List[List[int]]] = Field(
+        None,
+        description="One bounding box per object [[x_min, y_min, x_max, y_max], ...]",
+        examples=[[[100, 100, 500, 500], [600, 100, 900, 400]]]
+    )
+    points: Optional[List[List[List[int]]]] = Field(
+        None,
+        description="One group of point coordinates per object [[[x, y], ...], ...]",
+        examples=[[[[300, 300]], [[750, 250], [800, 300]]]]
+    )
+    labels: Optional[List[List[int]]] = Field(
+        None,
+        description="Labels for each point group (1=positive click, 0=negative click)",
+        examples=[[[1], [1, 1]]]
+    )
+    output_format: MaskFormat = Field(
+        MaskFormat.ZIP,
+        description="Mask encoding: 'zip' (PNG per mask), 'rle' (COCO RLE as JSON) or 'packbits' (bit-packed buffer after a length-prefixed JSON preamble)"
+    )
@@ -1,3 +1,5 @@
 from .generation import router as generation_router
+from .jobs import router as jobs_router
 from .object_detection import router as object_detection_router
+from .pipeline import router as pipeline_router
 from .segmentation import router as segmentation_router
@@ -1,20 +1,26 @@
+import base64
+import io
 import json
+import zipfile
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 from fastapi import APIRouter, UploadFile, File, Response, HTTPException, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import ValidationError
 
-from ..internal.generation import QwenImageGenerator
-from ..models.generation import GenerateInput, InpaintInput, GenerateRequest, InpaintRequest
+from ..internal.generation import QwenImageGeneratorPool
+from ..internal.worker import QueueFullError
+from ..models.generation import GenerateInput, InpaintInput, GenerateRequest, InpaintRequest, GeneratorOutput
 
-generator: Optional[QwenImageGenerator] = None
+generator: Optional[QwenImageGeneratorPool] = None
 
 
 @asynccontextmanager
 async def lifespan(fastapi_router: APIRouter):
     global generator
-    generator = QwenImageGenerator()
+    generator = QwenImageGeneratorPool()
     yield
     generator.stop()
     generator = None
@@ -23,8 +29,117 @@ async def lifespan(fastapi_router: APIRouter):
 router = APIRouter(prefix="", tags=["image_generation"], lifespan=lifespan)
 
 
+def build_generate_input(request: GenerateRequest) -> GenerateInput:
+    return GenerateInput(
+        prompt=request.prompt,
+        negative_prompt=request.negative_prompt,
+        width=request.width,
+        height=request.height,
+        num_inference_steps=request.num_inference_steps,
+        true_cfg_scale=request.true_cfg_scale,
+        seed=request.seed,
+        num_images=request.num_images,
+        cache_threshold=request.cache_threshold,
+        output_format=request.output_format,
+        quality=request.quality,
+        compress_level=request.compress_level
+    )
+
+
+def build_inpaint_input(request: InpaintRequest, control_image_bytes: bytes, control_mask_bytes: bytes) -> InpaintInput:
+    return InpaintInput(
+        prompt=request.prompt,
+        control_image=control_image_bytes,
+        control_mask=control_mask_bytes,
+        negative_prompt=request.negative_prompt,
+        num_inference_steps=request.num_inference_steps,
+        true_cfg_scale=request.true_cfg_scale,
+        controlnet_conditioning_scale=request.controlnet_conditioning_scale,
+        seed=request.seed,
+        crop_to_mask=request.crop_to_mask,
+        crop_padding=request.crop_padding,
+        crop_resolution=request.crop_resolution,
+        feather=request.feather,
+        output_format=request.output_format,
+        quality=request.quality,
+        compress_level=request.compress_level
+    )
+
+
+def create_image_zip(images: list, extension: str = "png") -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        for i, image_bytes in enumerate(images):
+            zf.writestr(f'{i}.{extension}', image_bytes)
+
+    buf.seek(0)
+    return buf.getvalue()
+
+
+def cache_headers(result: GeneratorOutput) -> dict:
+    if result.cache_skip_ratio is None:
+        return {}
+    return {"X-Cache-Skip-Ratio": f"{result.cache_skip_ratio:.3f}"}
+
+
+async def image_response(result: GeneratorOutput, filename: str) -> Response:
+    if len(result.images) == 1:
+        return Response(
+            content=result.image,
+            media_type=result.media_type,
+            headers={
+                "Content-Disposition": f"inline; filename={filename}.{result.extension}",
+                **cache_headers(result)
+            }
+        )
+
+    zip_bytes = await run_in_threadpool(create_image_zip, result.images, result.extension)
+    return Response(
+        content=zip_bytes,
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}.zip",
+            **cache_headers(result)
+        }
+    )
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def progress_stream(events: AsyncIterator[tuple], failure_message: str) -> AsyncIterator[str]:
+    async for event, data in events:
+        if event != "result":
+            yield sse_event(event, data)
+            continue
+
+        status, result = data
+        if status == "error":
+            yield sse_event("error", {"detail": f"{failure_message}: {result}"})
+        else:
+            images = [base64.b64encode(image).decode("ascii") for image in result.images]
+            yield sse_event("result", {
+                "media_type": result.media_type,
+                "image": images[0],
+                "images": images,
+                "cache_skip_ratio": result.cache_skip_ratio
+            })
+
+
+def sse_response(stream: AsyncIterator[str]) -> StreamingResponse:
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
 @router.post("/generate")
-def generate_image(
+async def generate_image(
     data: str = Form(..., description="JSON string with generation parameters"),
 ):
     if not generator:
@@ -34,26 +149,15 @@ def generate_image(
         data_dict = json.loads(data)
         request = GenerateRequest(**data_dict)
 
-        input_data = GenerateInput(
-            prompt=request.prompt,
-            negative_prompt=request.negative_prompt,
-            width=request.width,
-            height=request.height,
-            num_inference_steps=request.num_inference_steps,
-            true_cfg_scale=request.true_cfg_scale,
-            seed=request.seed
-        )
+        input_data = build_generate_input(request)
 
-        result = generator.generate(input_data)
+        result = await generator.generate(input_data)
 
-        return Response(
-            content=result.image,
-            media_type="image/png",
-            headers={
-                "Content-Disposition": "inline; filename=generated.png"
-            }
-        )
+        # One PNG, or a zip of PNGs when num_images > 1
+        return await image_response(result, "generated")
 
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
     except ValidationError as e:
@@ -63,7 +167,7 @@ def generate_image(
 
 
 @router.post("/inpaint")
-def inpaint_image(
+async def inpaint_image(
     control_image: UploadFile = File(..., description="Input image to inpaint"),
     control_mask: UploadFile = File(..., description="Mask image (white=inpaint, black=keep)"),
     data: str = Form(..., description="JSON string with inpainting parameters"),
@@ -75,30 +179,17 @@ def inpaint_image(
         data_dict = json.loads(data)
         request = InpaintRequest(**data_dict)
 
-        control_image_bytes = control_image.file.read()
-        control_mask_bytes = control_mask.file.read()
-
-        input_data = InpaintInput(
-            prompt=request.prompt,
-            control_image=control_image_bytes,
-            control_mask=control_mask_bytes,
-            negative_prompt=request.negative_prompt,
-            num_inference_steps=request.num_inference_steps,
-            true_cfg_scale=request.true_cfg_scale,
-            controlnet_conditioning_scale=request.controlnet_conditioning_scale,
-            seed=request.seed
-        )
+        control_image_bytes = await control_image.read()
+        control_mask_bytes = await control_mask.read()
 
-        result = generator.inpaint(input_data)
+        input_data = build_inpaint_input(request, control_image_bytes, control_mask_bytes)
 
-        return Response(
-            content=result.image,
-            media_type="image/png",
-            headers={
-                "Content-Disposition": "inline; filename=inpainted.png"
-            }
-        )
+        result = await generator.inpaint(input_data)
+
+        return await image_response(result, "inpainted")
 
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
     except ValidationError as e:
@@ -107,10 +198,63 @@ def inpaint_image(
         raise HTTPException(status_code=500, detail=f"Inpainting failed: {str(e)}")
 
 
+@router.post("/generate/stream")
+async def generate_image_stream(
+    data: str = Form(..., description="JSON string with generation parameters"),
+):
+    """Server-sent events: `queued`, per-step `progress`, then `result` (base64 PNG) or `error`."""
+    if not generator:
+        raise HTTPException(status_code=503, detail="Generator not initialized")
+
+    try:
+        data_dict = json.loads(data)
+        request = GenerateRequest(**data_dict)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+
+    try:
+        events = await generator.generate_stream(build_generate_input(request))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    return sse_response(progress_stream(events, "Generation failed"))
+
+
+@router.post("/inpaint/stream")
+async def inpaint_image_stream(
+    control_image: UploadFile = File(..., description="Input image to inpaint"),
+    control_mask: UploadFile = File(..., description="Mask image (white=inpaint, black=keep)"),
+    data: str = Form(..., description="JSON string with inpainting parameters"),
+):
+    """Server-sent events: `queued`, per-step `progress`, then `result` (base64 PNG) or `error`."""
+    if not generator:
+        raise HTTPException(status_code=503, detail="Generator not initialized")
+
+    try:
+        data_dict = json.loads(data)
+        request = InpaintRequest(**data_dict)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+
+    input_data = build_inpaint_input(request, await control_image.read(), await control_mask.read())
+    try:
+        events = await generator.inpaint_stream(input_data)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    return sse_response(progress_stream(events, "Inpainting failed"))
+
+
 @router.get("/health")
 def health_check():
     return {
         "status": "healthy" if generator else "not initialized",
-        "device": generator.device if generator else None,
-        "dtype": str(generator.torch_dtype) if generator else None
+        "device": generator.primary.device if generator else None,
+        "dtype": str(generator.primary.torch_dtype) if generator else None,
+        "queue": generator.queue_stats() if generator else None,
+        "result_cache": generator.result_cache.stats() if generator else None
     }
@@ -0,0 +1,147 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Optional
+
+from fastapi import APIRouter, UploadFile, File, HTTPException, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from pydantic import ValidationError
+
+from . import generation
+from .generation import build_generate_input, build_inpaint_input
+from ..configs import config
+from ..internal.jobs import JobStore
+from ..internal.worker import QueueFullError
+from ..models.generation import TaskType, GenerateRequest, InpaintRequest, IMAGE_FORMAT_FILES
+from ..models.jobs import JobRecord, JobStatus
+
+store: Optional[JobStore] = None
+# Keeps running job tasks referenced until they finish
+_tasks: set = set()
+
+
+async def cleanup_loop():
+    while True:
+        await asyncio.sleep(config.job_cleanup_interval_s)
+        await run_in_threadpool(store.cleanup)
+
+
+@asynccontextmanager
+async def lifespan(fastapi_router: APIRouter):
+    global store
+    store = JobStore(config.jobs_dir, ttl=config.job_ttl_s)
+    await run_in_threadpool(store.recover)
+    await run_in_threadpool(store.cleanup)
+    cleanup_task = asyncio.create_task(cleanup_loop())
+    yield
+    cleanup_task.cancel()
+    for task in list(_tasks):
+        task.cancel()
+    with suppress(asyncio.CancelledError):
+        await asyncio.gather(cleanup_task, *_tasks)
+    store = None
+
+
+router = APIRouter(prefix="", tags=["jobs"], lifespan=lifespan)
+
+
+async def run_job(record: JobRecord, events: AsyncIterator[tuple]):
+    try:
+        async for event, data in events:
+            if event == "queued":
+                store.update(record, persist=False, queue_position=data["position"])
+            elif event == "progress":
+                persist = record.status != JobStatus.RUNNING
+                await run_in_threadpool(
+                    store.update, record, persist=persist, status=JobStatus.RUNNING, queue_position=None, progress=data
+                )
+            elif event == "result":
+                status, result = data
+                if status == "error":
+                    await run_in_threadpool(store.fail, record, str(result))
+                else:
+                    await run_in_threadpool(store.save_result, record, result)
+    except Exception as e:
+        await run_in_threadpool(store.fail, record, str(e))
+
+
+@router.post("", response_model=JobRecord)
+async def submit_job(
+        task: TaskType = Form(..., description="'generate' or 'inpaint'"),
+        data: str = Form(..., description="JSON string with generation or inpainting parameters"),
+        control_image: Optional[UploadFile] = File(None, description="Input image to inpaint (inpaint only)"),
+        control_mask: Optional[UploadFile] = File(None, description="Mask image (inpaint only)"),
+):
+    """Queues a generation or inpainting job and returns its id without waiting for the result."""
+    generator = generation.generator
+    if not generator or not store:
+        raise HTTPException(status_code=503, detail="Generator not initialized")
+
+    try:
+        data_dict = json.loads(data)
+        if task == TaskType.GENERATE:
+            input_data = build_generate_input(GenerateRequest(**data_dict))
+            submit = generator.generate_stream
+        else:
+            if not control_image or not control_mask:
+                raise HTTPException(status_code=400, detail="Inpainting jobs require control_image and control_mask")
+            input_data = build_inpaint_input(InpaintRequest(**data_dict), await control_image.read(), await control_mask.read())
+            submit = generator.inpaint_stream
+
+    except HTTPException:
+        raise
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+
+    # The record exists before the work is queued, so a failure to create it cannot leave an orphaned GPU job
+    record = await run_in_threadpool(store.create, task)
+    try:
+        events = await submit(input_data)
+    except QueueFullError as e:
+        await run_in_threadpool(store.discard, record)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except Exception:
+        await run_in_threadpool(store.discard, record)
+        raise
+
+    job = asyncio.create_task(run_job(record, events))
+    _tasks.add(job)
+    job.add_done_callback(_tasks.discard)
+
+    return record
+
+
+@router.get("/{job_id}", response_model=JobRecord)
+async def get_job(job_id: str):
+    if not store:
+        raise HTTPException(status_code=503, detail="Job store not initialized")
+
+    record = await run_in_threadpool(store.get, job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return record
+
+
+@router.get("/{job_id}/result")
+async def get_job_result(job_id: str):
+    if not store:
+        raise HTTPException(status_code=503, detail="Job store not initialized")
+
+    record = await run_in_threadpool(store.get, job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if record.status == JobStatus.FAILED:
+        raise HTTPException(status_code=409, detail=f"Job failed: {record.error}")
+    if record.status != JobStatus.SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"Job is {record.status.value}")
+
+    extensions = {media_type: extension for media_type, extension in IMAGE_FORMAT_FILES.values()}
+    extension = extensions.get(record.media_type, "zip")
+    return FileResponse(
+        store.result_path(job_id),
+        media_type=record.media_type,
+        filename=f"{job_id}.{extension}"
+    )
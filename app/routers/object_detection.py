@@ -1,20 +1,22 @@
 import json
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, UploadFile, File, HTTPException, Form
 from pydantic import ValidationError
 
-from ..internal.object_detection import GDinoDetector, DetectorInput, DetectorOutput
+from ..internal.object_detection import GDinoDetectorPool, DetectorInput, DetectorBatchInput, DetectorOutput
+from ..internal.worker import QueueFullError
+from ..utils.cache import combined_stats
 from ..models.object_detection import DetectRequest
 
-detector: Optional[GDinoDetector] = None
+detector: Optional[GDinoDetectorPool] = None
 
 
 @asynccontextmanager
 async def lifespan(fastapi_router: APIRouter):
     global detector
-    detector = GDinoDetector()
+    detector = GDinoDetectorPool()
     yield
     detector.stop()
     detector = None
@@ -24,7 +26,7 @@ router = APIRouter(prefix="", tags=["object_detection"], lifespan=lifespan)
 
 
 @router.post("", response_model=DetectorOutput)
-def detect_objects(
+async def detect_objects(
         image: UploadFile = File(..., description="Image file to detect objects"),
         data: str = Form(..., description="JSON string with text prompts and thresholds"),
 ):
@@ -35,7 +37,7 @@ def detect_objects(
         data_dict = json.loads(data)
         request = DetectRequest(**data_dict)
 
-        image_bytes = image.file.read()
+        image_bytes = await image.read()
 
         input_data = DetectorInput(
             image=image_bytes,
@@ -43,9 +45,43 @@ def detect_objects(
             threshold=request.threshold,
         )
 
-        result = detector.detect(input_data)
+        result = await detector.detect(input_data)
         return result
 
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Detection failed: {str(e)}")
+
+
+@router.post("/batch", response_model=DetectorOutput)
+async def detect_objects_batch(
+        images: List[UploadFile] = File(..., description="Image files to detect objects in"),
+        data: str = Form(..., description="JSON string with text prompts and thresholds shared by all images"),
+):
+    if not detector:
+        raise HTTPException(status_code=503, detail="Detector not initialized")
+
+    try:
+        data_dict = json.loads(data)
+        request = DetectRequest(**data_dict)
+
+        input_data = DetectorBatchInput(
+            images=[await image.read() for image in images],
+            text=request.text,
+            threshold=request.threshold,
+        )
+
+        # One DetectionResult per image, in upload order
+        result = await detector.detect_batch(input_data)
+        return result
+
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
     except ValidationError as e:
@@ -58,6 +94,8 @@ def detect_objects(
 def health_check():
     return {
         "status": "healthy" if detector else "not initialized",
-        "device": detector.device if detector else None,
-        "model": detector.model_id if detector else None
+        "device": detector.primary.device if detector else None,
+        "model": detector.primary.model_id if detector else None,
+        "text_cache": combined_stats([replica.text_cache for replica in detector.replicas]) if detector else None,
+        "queue": detector.queue_stats() if detector else None
     }
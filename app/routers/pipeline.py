@@ -0,0 +1,74 @@
+import json
+
+from fastapi import APIRouter, UploadFile, File, HTTPException, Form
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+
+from . import object_detection, segmentation
+from .segmentation import mask_response
+from ..internal.worker import QueueFullError
+from ..models.object_detection import DetectorInput
+from ..models.pipeline import GroundedSegmentRequest
+from ..models.segmentation import SegmenterInput, SegmenterOutput, MaskFormat
+from ..utils.common import load_image, full_size, content_hash
+
+router = APIRouter(prefix="", tags=["pipeline"])
+
+
+@router.post("/grounded-segment")
+async def grounded_segment(
+        image: UploadFile = File(..., description="Image file to detect and segment objects in"),
+        data: str = Form(..., description="JSON string with text prompts and threshold"),
+):
+    detector = object_detection.detector
+    segmenter = segmentation.segmenter
+    if not detector or not segmenter:
+        raise HTTPException(status_code=503, detail="Detector or segmenter not initialized")
+
+    try:
+        data_dict = json.loads(data)
+        request = GroundedSegmentRequest(**data_dict)
+
+        image_bytes = await image.read()
+        # Decode once, at a size that suits both models, and hand the same image to both
+        min_sizes = [size for size in (detector.decode_min_size, segmenter.decode_min_size) if size]
+        pil_image = await run_in_threadpool(load_image, image_bytes, max(min_sizes) if len(min_sizes) == 2 else None)
+
+        detector_output = await detector.detect(DetectorInput(
+            image=pil_image,
+            text=request.text,
+            threshold=request.threshold,
+        ))
+        detection = detector_output.detections[0]
+
+        metadata = {
+            "boxes": detection.boxes,
+            "labels": detection.labels,
+            "detection_scores": detection.scores,
+        }
+
+        if not detection.boxes:
+            width, height = full_size(pil_image)
+            result = SegmenterOutput(
+                packed=b"" if request.output_format == MaskFormat.PACKBITS else None,
+                scores=[],
+                shape=(0, 1, height, width)
+            )
+        else:
+            result = await segmenter.segment(SegmenterInput(
+                image=pil_image,
+                image_key=content_hash(image_bytes),
+                boxes=[[round(coord) for coord in box] for box in detection.boxes],
+                output_format=request.output_format
+            ))
+
+        return await mask_response(result, request.output_format, metadata)
+
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Grounded segmentation failed: {str(e)}")
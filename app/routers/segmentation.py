@@ -1,23 +1,35 @@
 import io
 import json
+import struct
 import zipfile
 from contextlib import asynccontextmanager
 from typing import Optional
 
 from fastapi import APIRouter, UploadFile, File, Response
 from fastapi import HTTPException, Form
+from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import ValidationError
 
-from ..internal.segmentation import Sam2Segmenter, SegmenterInput
-from ..models.segmentation import PointSegmentRequest, BoxSegmentRequest, CombinedSegmentRequest
+from ..internal.segmentation import Sam2SegmenterPool, SegmenterInput
+from ..internal.worker import QueueFullError
+from ..utils.cache import combined_stats
+from ..models.segmentation import (
+    SegmenterOutput,
+    MaskFormat,
+    PointSegmentRequest,
+    BoxSegmentRequest,
+    CombinedSegmentRequest,
+    MultiSegmentRequest
+)
 
-segmenter: Optional[Sam2Segmenter] = None
+segmenter: Optional[Sam2SegmenterPool] = None
 
 
 @asynccontextmanager
 async def lifespan(fastapi_router: APIRouter):
     global segmenter
-    segmenter = Sam2Segmenter()
+    segmenter = Sam2SegmenterPool()
     yield
     segmenter.stop()
     segmenter = None
@@ -26,15 +38,17 @@ async def lifespan(fastapi_router: APIRouter):
 router = APIRouter(prefix="", tags=["segmentation"], lifespan=lifespan)
 
 
-def create_mask_zip(masks: list, scores: list, shape: tuple) -> bytes:
+def create_mask_zip(masks: list, scores: list, shape: tuple, extra_metadata: Optional[dict] = None) -> bytes:
     buf = io.BytesIO()
     with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
         for i, mask_bytes in enumerate(masks):
-            zf.writestr(f'{i}.png', mask_bytes)
+            # PNGs are already compressed, deflating them again only burns CPU
+            zf.writestr(f'{i}.png', mask_bytes, compress_type=zipfile.ZIP_STORED)
 
         metadata = {
             "scores": scores,
-            "shape": list(shape)
+            "shape": list(shape),
+            **(extra_metadata or {})
         }
         zf.writestr('metadata.json', json.dumps(metadata))
 
@@ -42,8 +56,49 @@ def create_mask_zip(masks: list, scores: list, shape: tuple) -> bytes:
     return buf.getvalue()
 
 
+def create_packbits_body(packed: bytes, metadata: dict) -> bytes:
+    """
+    A 4-byte big-endian length, that many bytes of JSON metadata, then the bit-packed masks.
+    Metadata grows with the number of masks (and detections on the pipeline route), so it is
+    kept out of the headers.
+    """
+    preamble = json.dumps(metadata).encode()
+    return struct.pack(">I", len(preamble)) + preamble + packed
+
+
+async def mask_response(
+        result: SegmenterOutput,
+        output_format: MaskFormat,
+        extra_metadata: Optional[dict] = None
+) -> Response:
+    metadata = {
+        "scores": result.scores,
+        "shape": list(result.shape),
+        **(extra_metadata or {})
+    }
+
+    if output_format == MaskFormat.RLE:
+        return JSONResponse(content={**metadata, "masks": result.rle})
+
+    if output_format == MaskFormat.PACKBITS:
+        return Response(
+            content=create_packbits_body(result.packed or b"", metadata),
+            media_type="application/octet-stream",
+            headers={"X-Mask-Shape": ",".join(str(dim) for dim in result.shape)}
+        )
+
+    zip_bytes = await run_in_threadpool(create_mask_zip, result.masks, result.scores, result.shape, extra_metadata)
+    return Response(
+        content=zip_bytes,
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": "attachment; filename=masks.zip"
+        }
+    )
+
+
 @router.post("/point")
-def segment_with_points(
+async def segment_with_points(
         image: UploadFile = File(..., description="Image file to segment"),
         data: str = Form(..., description="JSON string with points and labels"),
 ):
@@ -54,26 +109,21 @@ def segment_with_points(
         data_dict = json.loads(data)
         request = PointSegmentRequest(**data_dict)
 
-        image_bytes = image.file.read()
+        image_bytes = await image.read()
 
         input_data = SegmenterInput(
             image=image_bytes,
-            points=request.points,
-            labels=request.labels
+            points=[request.points],
+            labels=[request.labels],
+            output_format=request.output_format
         )
 
-        result = segmenter.segment(input_data)
+        result = await segmenter.segment(input_data)
 
-        zip_bytes = create_mask_zip(result.masks, result.scores, result.shape)
-
-        return Response(
-            content=zip_bytes,
-            media_type="application/zip",
-            headers={
-                "Content-Disposition": "attachment; filename=masks.zip"
-            }
-        )
+        return await mask_response(result, request.output_format)
 
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
     except ValidationError as e:
@@ -83,7 +133,7 @@ def segment_with_points(
 
 
 @router.post("/box")
-def segment_with_box(
+async def segment_with_box(
         image: UploadFile = File(..., description="Image file to segment"),
         data: str = Form(..., description="JSON string with box coordinates"),
 ):
@@ -94,25 +144,20 @@ def segment_with_box(
         data_dict = json.loads(data)
         request = BoxSegmentRequest(**data_dict)
 
-        image_bytes = image.file.read()
+        image_bytes = await image.read()
 
         input_data = SegmenterInput(
             image=image_bytes,
-            boxes=request.box
+            boxes=[request.box],
+            output_format=request.output_format
         )
 
-        result = segmenter.segment(input_data)
+        result = await segmenter.segment(input_data)
 
-        zip_bytes = create_mask_zip(result.masks, result.scores, result.shape)
-
-        return Response(
-            content=zip_bytes,
-            media_type="application/zip",
-            headers={
-                "Content-Disposition": "attachment; filename=masks.zip"
-            }
-        )
+        return await mask_response(result, request.output_format)
 
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
     except ValidationError as e:
@@ -122,7 +167,7 @@ def segment_with_box(
 
 
 @router.post("/combined")
-def segment_combined(
+async def segment_combined(
         image: UploadFile = File(..., description="Image file to segment"),
         data: str = Form(..., description="JSON string with points, labels, and/or box"),
 ):
@@ -142,27 +187,75 @@ def segment_combined(
         if request.points and not request.labels:
             raise HTTPException(status_code=400, detail="Points require labels")
 
-        image_bytes = image.file.read()
+        image_bytes = await image.read()
 
         input_data = SegmenterInput(
             image=image_bytes,
-            points=request.points,
-            labels=request.labels,
-            boxes=request.box
+            points=[request.points] if request.points else None,
+            labels=[request.labels] if request.labels else None,
+            boxes=[request.box] if request.box else None,
+            output_format=request.output_format
         )
 
-        result = segmenter.segment(input_data)
+        result = await segmenter.segment(input_data)
 
-        zip_bytes = create_mask_zip(result.masks, result.scores, result.shape)
+        return await mask_response(result, request.output_format)
 
-        return Response(
-            content=zip_bytes,
-            media_type="application/zip",
-            headers={
-                "Content-Disposition": "attachment; filename=masks.zip"
-            }
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Validation error: {e.errors()}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Segmentation failed: {str(e)}")
+
+
+@router.post("/multi")
+async def segment_multi(
+        image: UploadFile = File(..., description="Image file to segment"),
+        data: str = Form(..., description="JSON string with per-object boxes and/or point groups"),
+):
+    if not segmenter:
+        raise HTTPException(status_code=503, detail="Segmenter not initialized")
+
+    try:
+        data_dict = json.loads(data)
+        request = MultiSegmentRequest(**data_dict)
+
+        if not request.points and not request.boxes:
+            raise HTTPException(
+                status_code=400,
+                detail="Must provide either point groups+labels or boxes"
+            )
+
+        if request.points and (not request.labels or len(request.labels) != len(request.points)):
+            raise HTTPException(status_code=400, detail="Each point group requires a matching label group")
+
+        if request.points and request.boxes and len(request.points) != len(request.boxes):
+            raise HTTPException(status_code=400, detail="Point groups and boxes must describe the same objects")
+
+        if request.boxes and any(len(box) != 4 for box in request.boxes):
+            raise HTTPException(status_code=400, detail="Boxes must be [x_min, y_min, x_max, y_max]")
+
+        image_bytes = await image.read()
+
+        input_data = SegmenterInput(
+            image=image_bytes,
+            points=request.points,
+            labels=request.labels,
+            boxes=request.boxes,
+            output_format=request.output_format
         )
 
+        result = await segmenter.segment(input_data)
+
+        return await mask_response(result, request.output_format)
+
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in 'data' field: {str(e)}")
     except ValidationError as e:
@@ -175,6 +268,8 @@ def segment_combined(
 def health_check():
     return {
         "status": "healthy" if segmenter else "not initialized",
-        "device": segmenter.device if segmenter else None,
-        "model": segmenter.model_id if segmenter else None
+        "device": segmenter.primary.device if segmenter else None,
+        "model": segmenter.primary.model_id if segmenter else None,
+        "embedding_cache": combined_stats([replica.embedding_cache for replica in segmenter.replicas]) if segmenter else None,
+        "queue": segmenter.queue_stats() if segmenter else None
     }
@@ -1,13 +1,86 @@
+import hashlib
 import io
+import math
+from typing import Optional, Tuple, Union
 
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageOps
 
+from ..configs import config
+from .cache import LRUCache
 
-def load_image(image_bytes: bytes):
-    return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+# Decoded uploads by content, shared by every endpoint; cached images must not be modified in place
+decoded_image_cache = LRUCache(
+    max_items=config.decoded_image_cache_size,
+    max_bytes=config.decoded_image_cache_mb * 1024 * 1024
+)
 
 
-def image_to_bytes(image: Image.Image) -> bytes:
+def _open_image(image_bytes: bytes, min_size: Optional[int] = None) -> Tuple[Image.Image, Tuple[int, int]]:
+    # Reads the header only; `draft` just configures the decoder, after which `size` is the reduced size
+    image = Image.open(io.BytesIO(image_bytes))
+    width, height = image.size
+    if min_size and image.format == "JPEG" and min(width, height) > 2 * min_size:
+        scale = min_size / min(width, height)
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    return image, (width, height)
+
+
+def _finish_decode(image: Image.Image, stored_size: Tuple[int, int]) -> Image.Image:
+    width, height = stored_size
+    orientation = image.getexif().get(ImageOps.ExifTags.Base.Orientation, 1)
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    image = image.convert("RGB")
+    # Orientations 5-8 swap the axes
+    image.info["full_size"] = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+    return image
+
+
+def decode_image(image_bytes: bytes, min_size: Optional[int] = None) -> Image.Image:
+    """
+    Decodes to RGB in display orientation (EXIF applied). With `min_size`, JPEGs are decoded at
+    1/2, 1/4 or 1/8 scale as long as the shorter side stays at least `min_size`; the
+    full-resolution size is kept in `info["full_size"]`, see `full_size`.
+    """
+    return _finish_decode(*_open_image(image_bytes, min_size))
+
+
+def full_size(image: Image.Image) -> Tuple[int, int]:
+    """(width, height) of the upload before any reduced-size decode; coordinates are relative to it."""
+    return image.info.get("full_size", image.size)
+
+
+def load_image(image_bytes: Union[bytes, Image.Image], min_size: Optional[int] = None) -> Image.Image:
+    if isinstance(image_bytes, Image.Image):
+        # Already decoded in-process (e.g. by the pipeline router)
+        return image_bytes if image_bytes.mode == "RGB" else image_bytes.convert("RGB")
+
+    opened, stored_size = _open_image(image_bytes, min_size)
+    # Keyed by the size the decoder will produce rather than by `min_size`, so endpoints asking for
+    # different minimums share an entry whenever they end up at the same draft scale (or none)
+    key = (content_hash(image_bytes), opened.size)
+    image = decoded_image_cache.get(key)
+    if image is None:
+        image = _finish_decode(opened, stored_size)
+        decoded_image_cache.put(key, image, image.width * image.height * 3)
+    return image
+
+
+def image_to_bytes(image: Image.Image, output_format: str = "png", quality: int = 90, compress_level: int = 6) -> bytes:
+    """Encodes as png, webp or jpeg, or as a raw uint8 HxWx3 .npy array for "raw"."""
     buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
+    if output_format == "raw":
+        np.save(buffer, np.asarray(image.convert("RGB")), allow_pickle=False)
+    elif output_format == "png":
+        image.save(buffer, format="PNG", compress_level=compress_level)
+    else:
+        image.save(buffer, format=output_format.upper(), quality=quality)
     return buffer.getvalue()
+
+
+def content_hash(*chunks: bytes) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
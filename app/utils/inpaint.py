@@ -0,0 +1,77 @@
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+Box = Tuple[int, int, int, int]
+
+
+def mask_bbox(mask: Image.Image, threshold: int = 127) -> Optional[Box]:
+    """Bounding box (left, top, right, bottom) of the pixels to inpaint, or None for an empty mask."""
+    pixels = np.asarray(mask.convert("L")) > threshold
+    rows = np.flatnonzero(pixels.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(pixels.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def expand_box(box: Box, padding: int, image_size: Tuple[int, int]) -> Box:
+    left, top, right, bottom = box
+    width, height = image_size
+    return max(0, left - padding), max(0, top - padding), min(width, right + padding), min(height, bottom + padding)
+
+
+def working_size(size: Tuple[int, int], resolution: int, multiple: int = 16) -> Tuple[int, int]:
+    """Scales `size` to about `resolution`^2 pixels, keeping the aspect ratio, in multiples of `multiple`."""
+    width, height = size
+    scale = resolution / math.sqrt(width * height)
+    return (
+        max(multiple, round(width * scale / multiple) * multiple),
+        max(multiple, round(height * scale / multiple) * multiple)
+    )
+
+
+def _max_filter_1d(values: np.ndarray, radius: int, axis: int) -> np.ndarray:
+    # van Herk/Gil-Werman: prefix and suffix maxima within blocks of the window size make every window
+    # the max of two lookups, so the cost per pixel does not depend on the radius
+    size = 2 * radius + 1
+    values = np.moveaxis(values, axis, -1)
+    length = values.shape[-1]
+    tail = radius + (-(length + 2 * radius)) % size
+    padded = np.pad(values, [(0, 0)] * (values.ndim - 1) + [(radius, tail)])
+    blocks = padded.reshape(*padded.shape[:-1], -1, size)
+    prefix = np.maximum.accumulate(blocks, axis=-1).reshape(padded.shape)
+    suffix = np.maximum.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+    # The window of output i spans padded[i:i + size], which covers at most two blocks
+    result = np.maximum(suffix[..., :length], prefix[..., size - 1:size - 1 + length])
+    return np.moveaxis(result, -1, axis)
+
+
+def dilate_mask(mask: Image.Image, radius: int) -> Image.Image:
+    """Grey-level dilation of an "L" mask by a square of side 2 * radius + 1, like ImageFilter.MaxFilter."""
+    pixels = np.asarray(mask)
+    pixels = _max_filter_1d(_max_filter_1d(pixels, radius, axis=0), radius, axis=1)
+    return Image.fromarray(np.ascontiguousarray(pixels))
+
+
+def blend_crop(
+        original: Image.Image,
+        generated: Image.Image,
+        mask: Image.Image,
+        box: Box,
+        feather: int
+) -> Image.Image:
+    """Pastes `generated` (the inpainted crop at any size) back into `original` at `box`, feathering the mask edge."""
+    size = (box[2] - box[0], box[3] - box[1])
+    generated = generated.resize(size, Image.Resampling.LANCZOS)
+
+    alpha = mask.convert("L").crop(box)
+    if feather > 0:
+        # Grow the mask by the feather radius first so the blur fades outwards, not into the edit
+        alpha = dilate_mask(alpha, feather).filter(ImageFilter.GaussianBlur(feather / 2))
+
+    result = original.copy()
+    result.paste(generated, box[:2], alpha)
+    return result
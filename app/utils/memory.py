@@ -0,0 +1,129 @@
+import gc
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import torch
+
+from ..configs import config
+from .metrics import registry
+
+MEMORY_TRIMS = registry.counter("gpu_memory_trims_total", "Allocator cache trims (gc + empty_cache)", ["reason"])
+OOM_ERRORS = registry.counter("gpu_oom_errors_total", "Out-of-memory errors raised during inference")
+OOM_RETRIES = registry.counter("gpu_oom_retries_total", "Inference retried after an out-of-memory error", ["outcome"])
+
+
+def is_oom_error(error: BaseException) -> bool:
+    # MPS and some CUDA paths raise a plain RuntimeError instead of torch.OutOfMemoryError
+    return isinstance(error, torch.OutOfMemoryError) or (
+        isinstance(error, RuntimeError) and "out of memory" in str(error)
+    )
+
+
+def normalize_device(device: str) -> str:
+    """Canonical name of `device`, so "cuda" and "cuda:0" name the same GPU wherever devices are compared or keyed."""
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device() if torch.cuda.is_available() else 0)
+    return str(device)
+
+
+def pinned(tensor: torch.Tensor, device: str) -> torch.Tensor:
+    """Page-locked copy of a CPU tensor bound for a CUDA device, so `.to(device, non_blocking=True)` copies asynchronously."""
+    if str(device).startswith("cuda") and torch.cuda.is_available():
+        return tensor.pin_memory()
+    return tensor
+
+
+class MemoryManager:
+    """
+    Returns cached allocator memory to the device only when it is needed: when reserved memory
+    passes `high_water_mark` (a fraction of total device memory) after a batch, or after an
+    out-of-memory error, in which case the failed call is retried once.
+
+    The allocator functions default to torch.cuda and can be swapped out, which lets the
+    trimming policy run against fake numbers on CPU.
+    """
+
+    def __init__(
+            self,
+            device: str,
+            high_water_mark: float,
+            always_trim: bool = False,
+            memory_reserved: Optional[Callable[[], int]] = None,
+            total_memory: Optional[Callable[[], int]] = None,
+            empty_cache: Optional[Callable[[], None]] = None,
+            collect: Callable[[], Any] = gc.collect
+    ):
+        self.device = device
+        self.high_water_mark = high_water_mark
+        self.always_trim = always_trim
+
+        uses_cuda = str(device).startswith("cuda") and torch.cuda.is_available()
+        self._memory_reserved = memory_reserved or (
+            (lambda: torch.cuda.memory_reserved(device)) if uses_cuda else (lambda: 0)
+        )
+        self._total_memory = total_memory or (
+            (lambda: torch.cuda.get_device_properties(device).total_memory) if uses_cuda else (lambda: 0)
+        )
+        self._empty_cache = empty_cache or (torch.cuda.empty_cache if uses_cuda else (lambda: None))
+        self._collect = collect
+        self._lock = threading.Lock()
+
+    def above_high_water_mark(self) -> bool:
+        total = self._total_memory()
+        return total > 0 and self._memory_reserved() > self.high_water_mark * total
+
+    def trim(self, reason: str):
+        with self._lock:
+            self._collect()
+            self._empty_cache()
+        MEMORY_TRIMS.inc(reason=reason)
+
+    def maybe_trim(self) -> bool:
+        """Called after each batch; trims only when the allocator holds more than the high-water mark."""
+        if self.always_trim:
+            self.trim("always")
+            return True
+        if self.above_high_water_mark():
+            self.trim("high_water")
+            return True
+        return False
+
+    def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Calls `fn`; on an out-of-memory error trims the allocator cache and retries once."""
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+            OOM_ERRORS.inc()
+
+        # Trim outside the except block, so the traceback no longer pins the failed attempt's tensors
+        self.trim("oom")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_oom_error(e):
+                OOM_ERRORS.inc()
+            OOM_RETRIES.inc(outcome="failed")
+            raise
+        OOM_RETRIES.inc(outcome="succeeded")
+        return result
+
+
+_managers: Dict[str, MemoryManager] = {}
+_managers_lock = threading.Lock()
+
+
+def memory_manager_for(device: str) -> MemoryManager:
+    """The memory manager watching `device`, shared by every worker on it."""
+    device = normalize_device(device)
+    with _managers_lock:
+        manager = _managers.get(device)
+        if manager is None:
+            manager = _managers[device] = MemoryManager(
+                device=device,
+                high_water_mark=config.gpu_memory_high_water_mark,
+                always_trim=config.cuda_frequent_empty_cache
+            )
+        return manager
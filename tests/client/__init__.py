@@ -1,3 +1,5 @@
 from .object_detection import DetectionClient, DetectorOutput
 from .segmentation import SegmentationClient, SegmentationResult
 from .generation import ImageGenerationClient
+from .pipeline import PipelineClient
+from .jobs import JobClient
@@ -1,13 +1,14 @@
-import io
+import base64
+import json
 import os
 from os import PathLike
-from typing import Union, Optional
+from typing import Callable, List, Union, Optional
 
 import requests
 from PIL import Image
 
 from .models import GenerateRequest, InpaintRequest
-from .utils import process_image, print_and_raise_for_status
+from .utils import process_image, print_and_raise_for_status, decode_image, decode_image_response
 
 
 class ImageGenerationClient:
@@ -23,8 +24,14 @@ class ImageGenerationClient:
             height: int = 928,
             num_inference_steps: int = 50,
             true_cfg_scale: float = 4.0,
-            seed: Optional[int] = None
-    ) -> Image.Image:
+            seed: Optional[int] = None,
+            num_images: int = 1,
+            cache_threshold: Optional[float] = None,
+            output_format: str = "png",
+            quality: int = 90,
+            compress_level: int = 6
+    ) -> Union[Image.Image, List[Image.Image]]:
+        """Returns one image, or a list of `num_images` variations when more than one is requested."""
         request = GenerateRequest(
             prompt=prompt,
             negative_prompt=negative_prompt,
@@ -32,14 +39,19 @@ class ImageGenerationClient:
             height=height,
             num_inference_steps=num_inference_steps,
             true_cfg_scale=true_cfg_scale,
-            seed=seed
+            seed=seed,
+            num_images=num_images,
+            cache_threshold=cache_threshold,
+            output_format=output_format,
+            quality=quality,
+            compress_level=compress_level
         )
 
         data = {"data": request.model_dump_json()}
         response = self.session.post(f"{self.base_url}/generate", data=data)
         print_and_raise_for_status(response)
 
-        return Image.open(io.BytesIO(response.content))
+        return decode_image_response(response)
 
     def inpaint(
             self,
@@ -50,7 +62,14 @@ class ImageGenerationClient:
             num_inference_steps: int = 30,
             true_cfg_scale: float = 4.0,
             controlnet_conditioning_scale: float = 1.0,
-            seed: Optional[int] = None
+            seed: Optional[int] = None,
+            crop_to_mask: bool = False,
+            crop_padding: int = 64,
+            crop_resolution: int = 1024,
+            feather: int = 16,
+            output_format: str = "png",
+            quality: int = 90,
+            compress_level: int = 6
     ) -> Image.Image:
         request = InpaintRequest(
             prompt=prompt,
@@ -58,7 +77,14 @@ class ImageGenerationClient:
             num_inference_steps=num_inference_steps,
             true_cfg_scale=true_cfg_scale,
             controlnet_conditioning_scale=controlnet_conditioning_scale,
-            seed=seed
+            seed=seed,
+            crop_to_mask=crop_to_mask,
+            crop_padding=crop_padding,
+            crop_resolution=crop_resolution,
+            feather=feather,
+            output_format=output_format,
+            quality=quality,
+            compress_level=compress_level
         )
 
         files = {
@@ -70,7 +96,35 @@ class ImageGenerationClient:
         response = self.session.post(f"{self.base_url}/inpaint", files=files, data=data)
         print_and_raise_for_status(response)
 
-        return Image.open(io.BytesIO(response.content))
+        return decode_image_response(response)
+
+    def generate_with_progress(
+            self,
+            prompt: str,
+            on_event: Optional[Callable[[str, dict], None]] = None,
+            **kwargs
+    ) -> Image.Image:
+        """Streams /generate/stream; `on_event` receives every queued/progress event."""
+        request = GenerateRequest(prompt=prompt, **kwargs)
+
+        data = {"data": request.model_dump_json()}
+        response = self.session.post(f"{self.base_url}/generate/stream", data=data, stream=True)
+        print_and_raise_for_status(response)
+
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                payload = json.loads(line[len("data: "):])
+                if event == "result":
+                    return decode_image(base64.b64decode(payload["image"]), payload["media_type"])
+                if event == "error":
+                    raise RuntimeError(payload["detail"])
+                if on_event:
+                    on_event(event, payload)
+
+        raise RuntimeError("Stream ended without a result")
 
     def health_check(self) -> dict:
         response = self.session.get(f"{self.base_url}/health")
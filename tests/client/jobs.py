@@ -0,0 +1,58 @@
+import time
+from os import PathLike
+from typing import List, Optional, Union
+
+import requests
+from PIL import Image
+
+from .models import GenerateRequest, InpaintRequest
+from .utils import process_image, print_and_raise_for_status, decode_image_response
+
+
+class JobClient:
+    def __init__(self, base_url: str = "http://localhost:8000"):
+        self.base_url = f"{base_url.rstrip('/')}/jobs"
+        self.session = requests.Session()
+
+    def submit_generate(self, request: GenerateRequest) -> dict:
+        data = {"task": "generate", "data": request.model_dump_json()}
+        response = self.session.post(self.base_url, data=data)
+        print_and_raise_for_status(response)
+        return response.json()
+
+    def submit_inpaint(
+            self,
+            control_image: Union[str, PathLike, bytes, Image.Image],
+            control_mask: Union[str, PathLike, bytes, Image.Image],
+            request: InpaintRequest
+    ) -> dict:
+        files = {
+            "control_image": ("image.png", process_image(control_image), "image/png"),
+            "control_mask": ("mask.png", process_image(control_mask), "image/png")
+        }
+        data = {"task": "inpaint", "data": request.model_dump_json()}
+        response = self.session.post(self.base_url, files=files, data=data)
+        print_and_raise_for_status(response)
+        return response.json()
+
+    def status(self, job_id: str) -> dict:
+        response = self.session.get(f"{self.base_url}/{job_id}")
+        print_and_raise_for_status(response)
+        return response.json()
+
+    def result(self, job_id: str) -> Union[Image.Image, List[Image.Image]]:
+        response = self.session.get(f"{self.base_url}/{job_id}/result")
+        print_and_raise_for_status(response)
+        return decode_image_response(response)
+
+    def wait(self, job_id: str, poll_interval: float = 2.0, timeout: Optional[float] = None) -> Union[Image.Image, List[Image.Image]]:
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            job = self.status(job_id)
+            if job["status"] == "succeeded":
+                return self.result(job_id)
+            if job["status"] == "failed":
+                raise RuntimeError(f"Job {job_id} failed: {job['error']}")
+            if deadline and time.monotonic() > deadline:
+                raise TimeoutError(f"Job {job_id} still {job['status']} after {timeout}s")
+            time.sleep(poll_interval)
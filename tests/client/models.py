@@ -1,25 +1,45 @@
 import io
 import json
+import struct
 import zipfile
 from typing import List, Optional
 
+import numpy as np
 from PIL import Image
 from pydantic import BaseModel
 
 
+def decode_rle(rle: dict) -> np.ndarray:
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape((height, width), order="F")
+
+
 class PointSegmentRequest(BaseModel):
     points: List[List[int]]
     labels: List[int]
+    output_format: str = "zip"
 
 
 class BoxSegmentRequest(BaseModel):
     box: List[int]
+    output_format: str = "zip"
 
 
 class CombinedSegmentRequest(BaseModel):
     points: Optional[List[List[int]]] = None
     labels: Optional[List[int]] = None
     box: Optional[List[int]] = None
+    output_format: str = "zip"
+
+
+class MultiSegmentRequest(BaseModel):
+    boxes: Optional[List[List[int]]] = None
+    points: Optional[List[List[List[int]]]] = None
+    labels: Optional[List[List[int]]] = None
+    output_format: str = "zip"
 
 
 class DetectRequest(BaseModel):
@@ -27,6 +47,12 @@ class DetectRequest(BaseModel):
     threshold: float = 0.25
 
 
+class GroundedSegmentRequest(BaseModel):
+    text: List[str]
+    threshold: float = 0.25
+    output_format: str = "zip"
+
+
 class DetectionResult(BaseModel):
     boxes: List[List[float]]
     scores: List[float]
@@ -43,6 +69,30 @@ class SegmentationResult:
         self._masks = None
         self._metadata = None
 
+    @classmethod
+    def from_response(cls, response) -> "SegmentationResult":
+        content_type = response.headers.get("content-type", "")
+
+        if content_type.startswith("application/json"):
+            body = response.json()
+            result = cls(b"")
+            result._masks = [Image.fromarray(decode_rle(rle).astype(np.uint8) * 255) for rle in body.pop("masks")]
+            result._metadata = body
+            return result
+
+        if content_type.startswith("application/octet-stream"):
+            # 4-byte big-endian metadata length, JSON metadata, then the bit-packed masks
+            shape = [int(dim) for dim in response.headers["X-Mask-Shape"].split(",")]
+            (length,) = struct.unpack(">I", response.content[:4])
+            packed = np.frombuffer(response.content, dtype=np.uint8, offset=4 + length)
+            masks = np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape[0], *shape[-2:])
+            result = cls(b"")
+            result._masks = [Image.fromarray(mask * 255) for mask in masks]
+            result._metadata = json.loads(response.content[4:4 + length])
+            return result
+
+        return cls(response.content)
+
     def extract_masks(self) -> List[Image.Image]:
         if self._masks is None:
             self._masks = []
@@ -67,6 +117,11 @@ class GenerateRequest(BaseModel):
     num_inference_steps: int = 50
     true_cfg_scale: float = 4.0
     seed: Optional[int] = None
+    num_images: int = 1
+    cache_threshold: Optional[float] = None
+    output_format: str = "png"
+    quality: int = 90
+    compress_level: int = 6
 
 
 class InpaintRequest(BaseModel):
@@ -76,3 +131,10 @@ class InpaintRequest(BaseModel):
     true_cfg_scale: float = 4.0
     controlnet_conditioning_scale: float = 1.0
     seed: Optional[int] = None
+    crop_to_mask: bool = False
+    crop_padding: int = 64
+    crop_resolution: int = 1024
+    feather: int = 16
+    output_format: str = "png"
+    quality: int = 90
+    compress_level: int = 6
@@ -27,6 +27,19 @@ class DetectionClient:
         print_and_raise_for_status(response)
         return DetectorOutput(**response.json())
 
+    def detect_batch(
+            self,
+            images: List[Union[str, PathLike, bytes, Image.Image]],
+            text: List[str],
+            threshold: float = 0.25
+    ) -> DetectorOutput:
+        request = DetectRequest(text=text, threshold=threshold)
+        files = [("images", process_image(image)) for image in images]
+        data = {"data": request.model_dump_json()}
+        response = self.session.post(f"{self.base_url}/batch", files=files, data=data)
+        print_and_raise_for_status(response)
+        return DetectorOutput(**response.json())
+
     def health_check(self) -> dict:
         response = self.session.get(f"{self.base_url}/health")
         print_and_raise_for_status(response)
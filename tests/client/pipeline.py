@@ -0,0 +1,28 @@
+from os import PathLike
+from typing import List, Union
+
+import requests
+from PIL import Image
+
+from .models import GroundedSegmentRequest, SegmentationResult
+from .utils import process_image, print_and_raise_for_status
+
+
+class PipelineClient:
+    def __init__(self, base_url: str = "http://localhost:8000"):
+        self.base_url = f"{base_url.rstrip('/')}/pipeline"
+        self.session = requests.Session()
+
+    def grounded_segment(
+            self,
+            image: Union[str, PathLike, bytes, Image.Image],
+            text: List[str],
+            threshold: float = 0.25,
+            output_format: str = "zip"
+    ) -> SegmentationResult:
+        request = GroundedSegmentRequest(text=text, threshold=threshold, output_format=output_format)
+        files = {"image": process_image(image)}
+        data = {"data": request.model_dump_json()}
+        response = self.session.post(f"{self.base_url}/grounded-segment", files=files, data=data)
+        print_and_raise_for_status(response)
+        return SegmentationResult.from_response(response)
@@ -5,7 +5,13 @@ from typing import List, Optional, Union
 import requests
 from PIL import Image
 
-from .models import SegmentationResult, PointSegmentRequest, BoxSegmentRequest, CombinedSegmentRequest
+from .models import (
+    SegmentationResult,
+    PointSegmentRequest,
+    BoxSegmentRequest,
+    CombinedSegmentRequest,
+    MultiSegmentRequest
+)
 from .utils import process_image, print_and_raise_for_status
 
 
@@ -18,40 +24,58 @@ class SegmentationClient:
             self,
             image: Union[str, PathLike, bytes, Image.Image],
             points: List[List[int]],
-            labels: List[int]
+            labels: List[int],
+            output_format: str = "zip"
     ) -> SegmentationResult:
-        request = PointSegmentRequest(points=points, labels=labels)
+        request = PointSegmentRequest(points=points, labels=labels, output_format=output_format)
         files = {"image": process_image(image)}
         data = {"data": request.model_dump_json()}
         response = self.session.post(f"{self.base_url}/point", files=files, data=data)
         print_and_raise_for_status(response)
-        return SegmentationResult(response.content)
+        return SegmentationResult.from_response(response)
 
     def segment_box(
             self,
             image: Union[str, PathLike, bytes, Image.Image],
-            box: List[int]
+            box: List[int],
+            output_format: str = "zip"
     ) -> SegmentationResult:
-        request = BoxSegmentRequest(box=box)
+        request = BoxSegmentRequest(box=box, output_format=output_format)
         files = {"image": process_image(image)}
         data = {"data": request.model_dump_json()}
         response = self.session.post(f"{self.base_url}/box", files=files, data=data)
         print_and_raise_for_status(response)
-        return SegmentationResult(response.content)
+        return SegmentationResult.from_response(response)
 
     def segment_combined(
             self,
             image: Union[str, PathLike, bytes, Image.Image],
             points: Optional[List[List[int]]] = None,
             labels: Optional[List[int]] = None,
-            box: Optional[List[int]] = None
+            box: Optional[List[int]] = None,
+            output_format: str = "zip"
     ) -> SegmentationResult:
-        request = CombinedSegmentRequest(points=points, labels=labels, box=box)
+        request = CombinedSegmentRequest(points=points, labels=labels, box=box, output_format=output_format)
         files = {"image": process_image(image)}
         data = {"data": request.model_dump_json()}
         response = self.session.post(f"{self.base_url}/combined", files=files, data=data)
         print_and_raise_for_status(response)
-        return SegmentationResult(response.content)
+        return SegmentationResult.from_response(response)
+
+    def segment_multi(
+            self,
+            image: Union[str, PathLike, bytes, Image.Image],
+            boxes: Optional[List[List[int]]] = None,
+            points: Optional[List[List[List[int]]]] = None,
+            labels: Optional[List[List[int]]] = None,
+            output_format: str = "zip"
+    ) -> SegmentationResult:
+        request = MultiSegmentRequest(boxes=boxes, points=points, labels=labels, output_format=output_format)
+        files = {"image": process_image(image)}
+        data = {"data": request.model_dump_json()}
+        response = self.session.post(f"{self.base_url}/multi", files=files, data=data)
+        print_and_raise_for_status(response)
+        return SegmentationResult.from_response(response)
 
     def health_check(self) -> dict:
         response = self.session.get(f"{self.base_url}/health")
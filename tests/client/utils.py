@@ -1,8 +1,11 @@
+import zipfile
 from io import BytesIO
 from os import PathLike
 from pathlib import Path
-from typing import Union, Optional
+from typing import List, Union, Optional
 
+import numpy as np
+import requests
 from PIL import Image, ImageDraw, ImageFont
 
 from .models import DetectorOutput
@@ -37,6 +40,26 @@ def process_image(
         raise TypeError(f"Unsupported image type: {type(image)}")
 
 
+def decode_image(content: bytes, media_type: str) -> Image.Image:
+    # "raw" results are uint8 arrays saved with np.save
+    if media_type == "application/x-npy":
+        return Image.fromarray(np.load(BytesIO(content)))
+    return Image.open(BytesIO(content))
+
+
+def decode_image_response(response: requests.Response) -> Union[Image.Image, List[Image.Image]]:
+    """One image, or a list of images for a zip response, in any of the generation output formats."""
+    if response.headers.get("Content-Type") != "application/zip":
+        return decode_image(response.content, response.headers.get("Content-Type"))
+
+    images = []
+    with zipfile.ZipFile(BytesIO(response.content)) as zf:
+        for name in sorted(zf.namelist(), key=lambda n: int(n.split(".")[0])):
+            media_type = "application/x-npy" if name.endswith(".npy") else None
+            images.append(decode_image(zf.read(name), media_type))
+    return images
+
+
 def draw_detections(
         image: Image.Image,
         detections: DetectorOutput,